@@ -4,14 +4,58 @@
 Candlestick strategy backtest functionality
 '''
 import os
+import time
+import shutil
+import tempfile
 import argparse
-from mktdata import init_marketdata, get_mkt_data, has_split_dividents, odd_data
-from helpers import load_symbols, find_candlestick_patterns, create_result_dir, create_table, mkdate
-from multiprocessing import Pool
+import numpy as np
+import profiling
+import resultcache
+from itertools import islice
+from collections import OrderedDict
+from mktdata import init_marketdata, prefetch_mkt_data, SharedMktData, use_shared_mkt_data, has_split_dividents, odd_data, split_dividents_mask, odd_data_mask, window_matrix, rolling_mean_std
+from helpers import load_symbols, stack_ohlc, find_pattern_event_matrix, matrix_pattern_events, create_result_dir, create_table, table_header, table_row, table_close, mkdate
+from multiprocessing import Pool, cpu_count
+from txnlog import create_log, TxnLogWriter, TxnLog
+from outofcore import peak_rss, symbol_chunks
+
+
+HOLD_DAYS = [1, 2, 3, 5, 9]
+BUY_SIDES = [0, 1]
+LIMITS = [0.01, 0.015, 0.02, 0.03, 0.05]
+PATTERN_BATCH = 64  # symbols evaluated by candlestick function at once, bounds memory of stacked market data
+EXIT_POLICIES = {'fixed': [], 'trailing': [], 'target': [0.05], 'bands': [20, 2.0]}  # policy -> default params
+
+
+def parse_exit_policy(spec):
+    '''
+    Exit policy spec: fixed | trailing | target[:PROFIT] | bands[:DAYS[:WIDTH]], e.g. target:0.05, bands:20:2
+    fixed - close after hold days, limit is a stop loss level checked against hold window low/high
+    trailing - limit is a trailing stop distance from the best price since open
+    target - close at PROFIT target, limit is a stop loss level
+    bands - close when close price leaves Bollinger bands of DAYS with WIDTH standard deviations, limit is a stop loss level
+    Returns (policy, params)
+    '''
+    items = spec.split(':')
+    if items[0] not in EXIT_POLICIES or len(items) - 1 > len(EXIT_POLICIES[items[0]]):
+        raise ValueError('Unknown exit policy: %s' % spec)
+    defaults = EXIT_POLICIES[items[0]]
+    try:
+        params = [type(d)(x) for (d, x) in zip(defaults, items[1:])] + defaults[len(items) - 1:]
+    except ValueError:
+        raise ValueError('Bad exit policy params: %s' % spec)
+    if items[0] == 'target' and not params[0] > 0:
+        raise ValueError('Exit policy PROFIT should be > 0: %s' % spec)
+    if items[0] == 'bands' and (params[0] < 1 or not params[1] > 0):
+        raise ValueError('Exit policy DAYS should be >= 1 and WIDTH > 0: %s' % spec)
+    return (items[0], params)
 
 
 class StrategyRunner(object):
-    def __init__(self, pattern_alg, alg_value, hold_days, buy_side, limit, commision=0.0035, txn_amount=10000):
+    def __init__(self, pattern_alg, alg_value, hold_days, buy_side, limit, commision=0.0035, txn_amount=10000, exit_policy='fixed'):
+        '''
+        exit_policy - see parse_exit_policy, every position is closed after hold_days at the latest
+        '''
         self._pattern_alg = pattern_alg
         self._alg_value = alg_value
         self._buy_side = buy_side
@@ -19,7 +63,8 @@ class StrategyRunner(object):
         self._limit = limit
         self._commision = commision
         self._txn_amount = txn_amount
-        #TODO: closing should be based on bollinger bands or sliding. Also we can close position when price reached some level (e.g. 10% grow).
+        self._exit_policy = exit_policy
+        self._exit = parse_exit_policy(exit_policy)
 
         self.balance = 0
         self.txns = []  # txns format (symbol, buy_date, sell_date, buy_price, sell_price, profit)
@@ -50,6 +95,148 @@ class StrategyRunner(object):
         self.txns.append((symbol, mdata['date'][open_idx], mdata['date'][close_idx], open_position, close_position, profit))
         self.balance += profit
 
+    def _positions(self, mdata_idxs, mdata):
+        '''
+        Finds positions for array of events, returns (valid, open_idx, close_idx)
+        valid - mask of events which can be traded, open_idx/close_idx - indexes of valid positions
+        '''
+        mdata_len = len(mdata['open'])
+        open_idx = np.minimum(mdata_idxs + 1, mdata_len - 1)  # we can buy at day idx+1
+        close_idx = np.minimum(mdata_idxs + 1 + self._hold_days, mdata_len - 1)
+
+        valid = (close_idx - open_idx >= self._hold_days / 2) & (close_idx > open_idx)  # skip events if we don't have enough days
+        valid &= ~split_dividents_mask(mdata, np.maximum(open_idx - 5, 0), close_idx)  # skip events if split/dividents happens
+        valid &= ~odd_data_mask(mdata['open'][open_idx], mdata['open'][close_idx])  # skip odd events
+        return (valid, open_idx[valid], close_idx[valid])
+
+    def _process_positions(self, symbol, mdata_idxs, mdata):
+        '''
+        Vectorized _process_position for array of events
+        mdata_idxs - positions in market data when events happen
+        '''
+        (_, open_idx, close_idx) = self._positions(mdata_idxs, mdata)
+        if len(open_idx) == 0:
+            return
+        if self._exit[0] != 'fixed':
+            width = max(self._hold_days, 1)
+            lows = window_matrix(mdata['low'], open_idx, close_idx, width)
+            highs = window_matrix(mdata['high'], open_idx, close_idx, width)
+            self._exit_positions(symbol, mdata, open_idx, close_idx, lows, highs)
+            return
+        if self._buy_side:
+            limit_level = window_matrix(mdata['low'], open_idx, close_idx, max(self._hold_days, 1)).min(axis=1)
+        else:
+            limit_level = window_matrix(mdata['high'], open_idx, close_idx, max(self._hold_days, 1)).max(axis=1)
+        self._close_positions(symbol, mdata, open_idx, close_idx, limit_level)
+
+    @profiling.timed('pnl', lambda self, *args: self._pattern_alg)
+    def _close_positions(self, symbol, mdata, open_idx, close_idx, limit_level):
+        ''' Books transactions for valid positions, limit_level - min low (long) or max high (short) over hold window '''
+        open_position = mdata['open'][open_idx]
+        close_position = mdata['open'][close_idx]
+        if self._buy_side:
+            profit = self._process_long_positions(open_position, close_position, limit_level)
+        else:
+            profit = self._process_short_positions(open_position, close_position, limit_level)
+
+        self._book(zip([symbol] * len(profit), mdata['date'][open_idx], mdata['date'][close_idx], open_position, close_position, profit))
+
+    @profiling.timed('pnl', lambda self, *args: self._pattern_alg)
+    def _exit_positions(self, symbol, mdata, open_idx, close_idx, lows, highs, bands=None):
+        '''
+        Books transactions for valid positions closed by exit policy.
+        lows/highs - (positions x width) lows and highs from open day, width >= hold window
+        bands - optional {(days, width): (lower, upper)} bands of symbol shared by runners of StrategySweep
+        Exit bar is the first bar of hold window which hits exit rule, found by argmax over boolean mask.
+        '''
+        lengths = close_idx - open_idx
+        width = lows.shape[1]
+        in_window = np.arange(width) < lengths[:, None]
+        open_position = mdata['open'][open_idx]
+        if self._exit[0] == 'bands':
+            (hit, exit_price) = self._bands_exit(mdata, open_idx, open_position, lows, highs, *self._exit[1], bands=bands)
+        else:
+            (hit, exit_price) = getattr(self, '_%s_exit' % self._exit[0])(mdata, open_idx, open_position, lows, highs, *self._exit[1])
+        hit &= in_window
+        exited = hit.any(axis=1)
+        first = np.where(exited, hit.argmax(axis=1), lengths)
+        rows = np.arange(len(open_idx))
+        exit_idx = open_idx + first
+        close_position = np.where(exited, exit_price[rows, np.minimum(first, width - 1)], mdata['open'][close_idx])
+        cnt = np.trunc(self._txn_amount / open_position)
+        if self._buy_side:
+            profit = cnt * close_position - cnt * (open_position + open_position * self._commision)
+        else:
+            profit = cnt * (open_position - open_position * self._commision) - cnt * close_position
+        self._book(zip([symbol] * len(profit), mdata['date'][open_idx], mdata['date'][exit_idx], open_position, close_position, profit))
+
+    def _trailing_exit(self, mdata, open_idx, open_position, lows, highs):
+        ''' Stop at limit distance from the best price before the bar (open price included) '''
+        if self._buy_side:
+            stop = np.maximum.accumulate(np.column_stack((open_position, highs[:, :-1])), axis=1) * (1 - self._limit)
+            return (lows < stop, stop)
+        stop = np.minimum.accumulate(np.column_stack((open_position, lows[:, :-1])), axis=1) * (1 + self._limit)
+        return (highs > stop, stop)
+
+    def _target_exit(self, mdata, open_idx, open_position, lows, highs, target):
+        ''' Profit target and stop loss, stop wins if both are hit by the same bar '''
+        sign = 1 if self._buy_side else -1
+        stop = open_position - sign * open_position * self._limit
+        take = open_position + sign * open_position * target
+        if self._buy_side:
+            (stop_hit, take_hit) = (lows < stop[:, None], highs >= take[:, None])
+        else:
+            (stop_hit, take_hit) = (highs > stop[:, None], lows <= take[:, None])
+        price = np.where(stop_hit, stop[:, None], take[:, None])
+        return (stop_hit | take_hit, price)
+
+    def _bands_exit(self, mdata, open_idx, open_position, lows, highs, days, width, bands=None):
+        '''
+        Close price leaves Bollinger bands, position is closed at that close price.
+        Stop loss at limit is checked against bar low/high and wins if both are hit by the same bar.
+        bands - cache of bands over whole mdata, computed here if missing
+        '''
+        bands = {} if bands is None else bands
+        if (days, width) not in bands:
+            (mean, std) = rolling_mean_std(mdata['close'], days)
+            bands[(days, width)] = (mean - width * std, mean + width * std)
+        close_idx = np.minimum(open_idx + lows.shape[1], len(mdata['close']))  # bars after hold window are masked anyway
+        (closes, lower, upper) = [window_matrix(x, open_idx, close_idx, lows.shape[1]) for x in (mdata['close'],) + bands[(days, width)]]
+        with np.errstate(invalid='ignore'):  # no bands (NaN) before first days bars
+            hit = (closes > upper) | (closes < lower)
+        if self._buy_side:
+            stop = open_position - open_position * self._limit
+            stop_hit = lows < stop[:, None]
+        else:
+            stop = open_position + open_position * self._limit
+            stop_hit = highs > stop[:, None]
+        return (hit | stop_hit, np.where(stop_hit, stop[:, None], closes))
+
+    def _book(self, txns):
+        ''' Adds transactions and their profit to balance '''
+        if len(txns) == 0:
+            return
+        self.txns.extend(txns)
+        profit = np.array([x[5] for x in txns], dtype=np.float64)
+        self.balance = np.add.accumulate(np.append(self.balance, profit))[-1]  # sequential sum, same as adding one by one
+
+    def params(self):
+        return (self._pattern_alg, self._alg_value, self._hold_days, self._buy_side, self._limit)
+
+    def _process_long_positions(self, open_position, close_position, limit_level):
+        cnt = np.trunc(self._txn_amount / open_position)
+        open_amount = cnt * (open_position + open_position * self._commision)
+        stop_hit = limit_level < open_position - open_position * self._limit  # check if price moves below threshold
+        close_amount = np.where(stop_hit, cnt * (open_position - open_position * self._limit), cnt * close_position)
+        return close_amount - open_amount
+
+    def _process_short_positions(self, open_position, close_position, limit_level):
+        cnt = np.trunc(self._txn_amount / open_position)
+        open_amount = cnt * (open_position - open_position * self._commision)
+        stop_hit = limit_level > open_position + open_position * self._limit  # check if price moves above threshold
+        close_amount = np.where(stop_hit, cnt * (open_position + open_position * self._limit), cnt * close_position)
+        return open_amount - close_amount
+
     def _process_long_position(self, open_position, close_position, limit_level):
         cnt = int(self._txn_amount / open_position)
         open_amount = cnt * (open_position + open_position * self._commision)
@@ -70,19 +257,133 @@ class StrategyRunner(object):
 
         return open_amount - close_amount
 
-    def __call__(self, symbols, from_date, to_date):
-        for s in symbols:
-            mdata = get_mkt_data(s, from_date, to_date)
-            if mdata:
-                res = find_candlestick_patterns(self._pattern_alg, mdata)
-                for (idx, val) in res:
-                    if val == self._alg_value:
-                        try:
-                            self._process_position(s, idx, mdata)
-                        except:
-                            pass
+    def __call__(self, symbols, from_date, to_date, events=None):
+        '''
+        events - optional precomputed pattern events {symbol: (indexes, values)}, see pattern_event_index
+        '''
+        symbols = [s for s in symbols if s in events] if events is not None else symbols
+        for batch in symbol_batches(prefetch_mkt_data(symbols, from_date, to_date)):
+            index = events if events is not None else pattern_event_index(self._pattern_alg, batch)
+            for (s, mdata) in batch:
+                (idxs, vals) = index[s]
+                self._process_positions(s, idxs[vals == self._alg_value], mdata)
+        return self
+
+
+def symbol_batches(data, size=None):
+    '''
+    Splits (symbol, market data) iterator to lists of at most size (PATTERN_BATCH by default) symbols,
+    symbols without market data are skipped
+    '''
+    it = ((s, x) for (s, x) in data if x)
+    return iter(lambda: list(islice(it, size or PATTERN_BATCH)), [])
+
+
+def pattern_event_index(pattern_alg, data):
+    '''
+    Computes pattern events of many symbols in one batch, result can be shared by all strategies of the pattern
+    data - [(symbol, market data), ...] with market data of every symbol
+    Returns {symbol: (indexes, values)}
+    '''
+    (block, lengths) = stack_ohlc([x for (_, x) in data])
+    matrix = find_pattern_event_matrix(block, lengths, [pattern_alg])
+    return dict((s, matrix_pattern_events(matrix, i, 0)) for (i, (s, _)) in enumerate(data))
+
+
+class StrategySweep(object):
+    '''
+    Evaluates group of strategies of the same pattern (e.g. hold_days x buy_side x limit grid) in one pass.
+    Pattern events are found once per symbol and hold windows are gathered once for the longest hold period,
+    shorter periods use prefix min/max of the same windows.
+    '''
+    def __init__(self, strategies, commision=0.0035, txn_amount=10000, exit_policy='fixed'):
+        self.runners = [StrategyRunner(*(tuple(x) + (commision, txn_amount, exit_policy))) for x in strategies]
+        self._pattern_alg = strategies[0][0]
+
+    def _process_positions(self, symbol, idxs, vals, mdata, runners=None):
+        '''
+        runners - subset of runners to process, all by default
+        '''
+        runners = self.runners if runners is None else runners
+        bands = {}  # exit bands of symbol, computed once for all runners
+        for alg_value in sorted(set(r._alg_value for r in runners)):
+            value_runners = [r for r in runners if r._alg_value == alg_value]
+            mdata_idxs = idxs[vals == alg_value]
+            width = max(max(r._hold_days for r in value_runners), 1)
+            open_idx = np.minimum(mdata_idxs + 1, len(mdata['open']) - 1)
+            close_idx = np.minimum(mdata_idxs + 1 + width, len(mdata['open']) - 1)
+            window_lows = window_matrix(mdata['low'], open_idx, close_idx, width)
+            window_highs = window_matrix(mdata['high'], open_idx, close_idx, width)
+            lows = np.minimum.accumulate(window_lows, axis=1)
+            highs = np.maximum.accumulate(window_highs, axis=1)
+            positions = {}
+            for r in value_runners:
+                if r._hold_days not in positions:
+                    positions[r._hold_days] = r._positions(mdata_idxs, mdata)
+                (valid, open_idx, close_idx) = positions[r._hold_days]
+                if len(open_idx) == 0:
+                    continue
+                rows = np.flatnonzero(valid)
+                if r._exit[0] != 'fixed':
+                    r._exit_positions(symbol, mdata, open_idx, close_idx, window_lows[rows], window_highs[rows], bands)
+                else:
+                    limit_levels = lows if r._buy_side else highs
+                    r._close_positions(symbol, mdata, open_idx, close_idx, limit_levels[rows, close_idx - open_idx - 1])
+
+    def __call__(self, symbols, from_date, to_date, events=None):
+        '''
+        events - optional precomputed pattern events {symbol: (indexes, values)}, see pattern_event_index
+        '''
+        symbols = [s for s in symbols if s in events] if events is not None else symbols
+        for batch in symbol_batches(prefetch_mkt_data(symbols, from_date, to_date)):
+            if resultcache.enabled():
+                lookups = [(s, mdata) + self._cache_lookup(s, mdata, from_date, to_date) for (s, mdata) in batch]
+                misses = [(s, mdata) for (s, mdata, _, _, missing) in lookups if missing]  # only they need pattern events
+                index = events if events is not None or not misses else pattern_event_index(self._pattern_alg, misses)
+                for x in lookups:
+                    self._process_cached(*(x + (index,)))
+            else:
+                index = events if events is not None else pattern_event_index(self._pattern_alg, batch)
+                for (s, mdata) in batch:
+                    (idxs, vals) = index[s]
+                    self._process_positions(s, idxs, vals, mdata)
         return self
 
+    def _cache_lookup(self, symbol, mdata, from_date, to_date):
+        '''
+        Returns (key, cached, missing) - result cache entry of symbol and runners missing in it.
+        Cache entry is keyed by symbol market data and pattern, it maps full strategy params to symbol transactions.
+        '''
+        key = resultcache.make_key(symbol, resultcache.data_hash(mdata), self._pattern_alg, from_date, to_date)
+        cached = resultcache.load('backtesting', key) or {}
+        missing = [r for r in self.runners if r.params() + (r._commision, r._txn_amount, r._exit_policy) not in cached]
+        return (key, cached, missing)
+
+    def _process_cached(self, symbol, mdata, key, cached, missing, events):
+        '''
+        Books symbol transactions stored in result cache, only missing strategies are evaluated (see _cache_lookup).
+        events - pattern events of the symbol if any strategy is missing
+        '''
+        params = [r.params() + (r._commision, r._txn_amount, r._exit_policy) for r in self.runners]
+        if missing:
+            (idxs, vals) = events[symbol]
+            before = [len(r.txns) for r in missing]
+            self._process_positions(symbol, idxs, vals, mdata, missing)
+            for (r, n) in zip(missing, before):
+                cached[r.params() + (r._commision, r._txn_amount, r._exit_policy)] = r.txns[n:]
+            resultcache.save('backtesting', key, cached)
+        for (r, p) in zip(self.runners, params):
+            if r not in missing:
+                r._book(cached[p])
+
+    def results(self):
+        ''' Rows in backtesting.html format '''
+        return [r.params() + (r.balance,) for r in self.runners]
+
+
+def sweep_grid(pattern_alg, alg_value, hold_days=HOLD_DAYS, buy_sides=BUY_SIDES, limits=LIMITS):
+    return [(pattern_alg, alg_value, d, b, l) for d in hold_days for b in buy_sides for l in limits]
+
 
 def load_strategies(fname):
     with open(fname) as f:
@@ -99,35 +400,180 @@ def output_transactions(outpath, sparams, txns):
         create_table(f, ['Symbol', 'Buy date', 'Sell date', 'Buy price', 'Sell prive', 'Profit'], txns, ['%s', '%s', '%s', '%f', '%f', '%f'])
 
 
-def strategy_runner((outpath, symbols, from_date, to_date, strategy)):
-    sr = StrategyRunner(*strategy)(symbols, from_date, to_date)
-    output_transactions(outpath, (strategy[0], strategy[1], strategy[2], strategy[3], strategy[4]), sr.txns)
-    return (strategy[0], strategy[1], strategy[2], strategy[3], strategy[4], sr.balance)
+def group_strategies(strategies):
+    ''' Groups strategies by pattern algorithm, each item is kept with its position: [[(pos, strategy), ...], ...] '''
+    groups = OrderedDict()
+    for (i, x) in enumerate(strategies):
+        groups.setdefault(x[0], []).append((i, x))
+    return groups.values()
+
+
+def pattern_runner((outpath, symbols, from_date, to_date, strategies, exit_policy)):
+    ''' Runs group of strategies sharing pattern algorithm in one sweep '''
+    sw = StrategySweep([x for (_, x) in strategies], exit_policy=exit_policy)(symbols, from_date, to_date)
+    log = TxnLogWriter(outpath)  # symbols may be a chunk of log symbols
+    for ((i, _), r) in zip(strategies, sw.runners):
+        log.append(i, r.txns)
+    return zip([i for (i, _) in strategies], sw.results())
+
+
+def shared_pattern_runner((shared, job)):
+    ''' Pool job: pattern_runner over market data of SharedMktData copy made by mapped '''
+    use_shared_mkt_data(shared)
+    try:
+        return pattern_runner(job)
+    finally:
+        use_shared_mkt_data(None)
+
+
+def output_results(outpath, res):
+    ''' Writes results to backtesting.html and profit.html, rows are written as soon as they come from res iterator '''
+    header = ['Pattern', 'Pattern params', 'Hold days', 'Buy side', 'Limit', 'Profit']
+    value_format = ['%s', '%d', '%d', '%d', '%f', '%f']
+    with open(os.path.join(outpath, 'backtesting.html'), 'w') as f, open(os.path.join(outpath, 'profit.html'), 'w') as fp:
+        table_header(f, header)
+        table_header(fp, header)
+        for x in res:
+            table_row(f, x, value_format)
+            f.flush()
+            if x[5] > 1.0:
+                table_row(fp, x, value_format)
+                fp.flush()
+        table_close(f)
+        table_close(fp)
+
+
+def chunked_runner(outpath, symbols, from_date, to_date, groups, exit_policy, chunk_size, memory_limit=None, async=False, workers=None):
+    '''
+    Out-of-core run of pattern_runner jobs: symbols are processed in chunks (see symbol_chunks), transactions of every
+    chunk are spilled to transaction log, so memory holds market data and transactions of one chunk only.
+    With async one pool serves all chunks, market data of a chunk is passed to workers in a memory mapped file.
+    Returns results rows in strategies order computed from the log, the same as results of in-memory run.
+    '''
+    pool = Pool(workers) if async else None
+    tmp = tempfile.mkdtemp(prefix='backtesting-chunk-') if async else None
+    try:
+        for (i, chunk) in enumerate(symbol_chunks(symbols, chunk_size, memory_limit)):
+            jobs = [(outpath, chunk, from_date, to_date, x, exit_policy) for x in groups]
+            if pool is not None:
+                fname = os.path.join(tmp, '%d.npy' % i)
+                shared = SharedMktData(chunk, from_date, to_date).mapped(fname)
+                for (_, stats) in pool.imap_unordered(profiling.Job(shared_pattern_runner), [(shared, x) for x in jobs]):
+                    profiling.merge(stats)
+                os.remove(fname)
+            else:
+                for x in jobs:
+                    pattern_runner(x)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            shutil.rmtree(tmp)
+    log = TxnLog(outpath)
+    return [log.strategies[i] + (log.balance(i),) for i in range(len(log.strategies))]
 
 
-def backtesting_main(fname, from_date, to_date, strategies, async=False):
+def backtesting_main(fname, from_date, to_date, strategies, async=False, workers=None, profile=False, exit_policy='fixed', chunk_size=None, memory_limit=None):
+    '''
+    async - run strategies in a pool of workers (cpu count by default) and write results as they finish,
+            otherwise strategies are run serially and results are written in strategies file order
+    profile - write timing.json/timing.html with per stage, pattern and worker timings
+    exit_policy - exit policy of all strategies, see parse_exit_policy
+    chunk_size - out-of-core mode, see chunked_runner, results are written in strategies file order. Peak RSS is reported.
+    '''
+    start = time.time()
+    profiling.enable(profile)
     symbols = load_symbols(fname)
     init_marketdata(symbols, from_date, to_date)
     strategies_cfg = load_strategies(strategies)
     outpath = create_result_dir('backtesting')
+    create_log(outpath, symbols, strategies_cfg)
+
+    groups = sorted(group_strategies(strategies_cfg), key=len, reverse=True)  # one job per pattern, biggest first
+    jobs = [(outpath, symbols, from_date, to_date, x, exit_policy) for x in groups]
+
+    if chunk_size:
+        output_results(outpath, chunked_runner(outpath, symbols, from_date, to_date, groups, exit_policy, chunk_size, memory_limit, async, workers))
+        print('Peak RSS: %d MB' % (peak_rss() / 2 ** 20))
+    elif async:
+        shared = SharedMktData(symbols, from_date, to_date)  # loaded once, workers attach without copying
+        pool = Pool(workers, use_shared_mkt_data, (shared,))
+        output_results(outpath, _merge_stats(pool.imap_unordered(profiling.Job(pattern_runner), jobs)))
+        pool.close()
+        pool.join()
+    else:
+        res = [None] * len(strategies_cfg)
+        for group in (pattern_runner(x) for x in jobs):
+            for (i, x) in group:
+                res[i] = x
+        output_results(outpath, res)
+
+    if profile:
+        profiling.add('total', time.time() - start)
+        profiling.write_report(outpath)
+
+
+def _merge_stats(groups):
+    ''' Merges worker stats of profiling.Job results, yields results rows '''
+    for (group, stats) in groups:
+        profiling.merge(stats)
+        for (_, x) in group:
+            yield x
+
+
+def sweep_main(fname, from_date, to_date, pattern_alg, alg_value, hold_days, buy_sides, limits, exit_policy='fixed'):
+    symbols = load_symbols(fname)
+    init_marketdata(symbols, from_date, to_date)
+    outpath = create_result_dir('sweep')
 
-    pool = Pool(4)
-    res = pool.map(strategy_runner, [(outpath, symbols, from_date, to_date, x) for x in strategies_cfg])
+    strategies = sweep_grid(pattern_alg, alg_value, hold_days, buy_sides, limits)
+    create_log(outpath, symbols, strategies)
+    res = pattern_runner((outpath, symbols, from_date, to_date, list(enumerate(strategies)), exit_policy))
+    output_results(outpath, [x for (_, x) in res])
 
-    with open(os.path.join(outpath, 'backtesting.html'), 'w') as f:
-        create_table(f, ['Pattern', 'Pattern params', 'Hold days', 'Buy side', 'Limit', 'Profit'], res, ['%s', '%d', '%d', '%d', '%f', '%f'])
 
-    profitable = [x for x in res if x[5] > 1.0]
-    with open(os.path.join(outpath, 'profit.html'), 'w') as f:
-        create_table(f, ['Pattern', 'Pattern params', 'Hold days', 'Buy side', 'Limit', 'Profit'], profitable, ['%s', '%d', '%d', '%d', '%f', '%f'])
+def output_log_transactions(outpath, strategy_ids=None):
+    ''' Generates txns_*.html tables from transaction log of results directory '''
+    log = TxnLog(outpath)
+    for i in (strategy_ids if strategy_ids is not None else range(len(log.strategies))):
+        output_transactions(outpath, log.strategies[i], log.txns(i))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Candlestick strategy backtesting')
-    parser.add_argument('-f', '--fromdate', metavar='YYYYMMDD', type=mkdate, required=True, help='from date in format YYYYMMDD')
-    parser.add_argument('-t', '--todate', metavar='YYYYMMDD', type=mkdate, required=True, help='from date in format YYYYMMDD')
-    parser.add_argument('-s', '--shares', metavar='FILENAME', type=str, required=True, help='file with list of shares')
-    parser.add_argument('strategies', metavar='STRATEGIES_FILE', type=str, nargs=1, help='')
+    parser.add_argument('-f', '--fromdate', metavar='YYYYMMDD', type=mkdate, help='from date in format YYYYMMDD')
+    parser.add_argument('-t', '--todate', metavar='YYYYMMDD', type=mkdate, help='from date in format YYYYMMDD')
+    parser.add_argument('-s', '--shares', metavar='FILENAME', type=str, help='file with list of shares')
+    parser.add_argument('strategies', metavar='STRATEGIES_FILE', type=str, nargs='?', help='')
+    parser.add_argument('--sweep', metavar=('PATTERN', 'VALUE'), nargs=2, help='evaluate hold days x buy side x limit grid of one pattern instead of strategies file')
+    parser.add_argument('--days', metavar='N', type=int, nargs='+', default=HOLD_DAYS, help='sweep hold days')
+    parser.add_argument('--buy', metavar='N', type=int, nargs='+', default=BUY_SIDES, help='sweep buy sides')
+    parser.add_argument('--limits', metavar='X', type=float, nargs='+', default=LIMITS, help='sweep limits')
+    parser.add_argument('--exit', metavar='POLICY', type=str, default='fixed', help='exit policy: fixed, trailing, target[:PROFIT] or bands[:DAYS[:WIDTH]]')
+    parser.add_argument('-w', '--workers', metavar='N', type=int, default=cpu_count(), help='number of worker processes')
+    parser.add_argument('--serial', action='store_true', help='run strategies serially and keep strategies file order in results')
+    parser.add_argument('--profile', action='store_true', help='write per stage timing report to results directory')
+    parser.add_argument('--txns-html', metavar='RESULTS_DIR', type=str, help='generate transaction tables from transaction log of results directory')
+    parser.add_argument('--ids', metavar='N', type=int, nargs='+', help='strategy ids (positions in strategies file) for --txns-html, all by default')
+    parser.add_argument('--result-cache', metavar='DIR', type=str, default=resultcache.RESULT_CACHE_DIR, help='per symbol results cache, only symbols and strategies with changed inputs are recomputed')
+    parser.add_argument('--no-result-cache', action='store_true', help='recompute everything')
+    parser.add_argument('--chunk-size', metavar='N', type=int, help='out-of-core mode: process N symbols at a time, transactions are spilled to transaction log')
+    parser.add_argument('--memory-limit', metavar='MB', type=int, help='with --chunk-size: halve chunks while resident memory exceeds MB (best-effort, not a hard ceiling)')
 
     args = parser.parse_args()
-    backtesting_main(args.shares, args.fromdate, args.todate, args.strategies[0])
+    resultcache.set_result_cache_dir(None if args.no_result_cache else args.result_cache)
+    try:
+        parse_exit_policy(args.exit)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.txns_html:
+        output_log_transactions(args.txns_html, args.ids)
+    elif not (args.fromdate and args.todate and args.shares):
+        parser.error('-f/--fromdate, -t/--todate and -s/--shares are required')
+    elif args.sweep:
+        sweep_main(args.shares, args.fromdate, args.todate, args.sweep[0], int(args.sweep[1]), args.days, args.buy, args.limits, args.exit)
+    elif args.strategies:
+        backtesting_main(args.shares, args.fromdate, args.todate, args.strategies, not args.serial, args.workers, args.profile, args.exit,
+                         args.chunk_size, args.memory_limit * 2 ** 20 if args.memory_limit else None)
+    else:
+        parser.error('STRATEGIES_FILE or --sweep is required')
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding:utf-8
+'''
+Benchmarks on synthetic market data, no marketdata db or network is needed
+'''
+import os
+import json
+import zlib
+import time
+import timeit
+import argparse
+import shutil
+import tempfile
+import numpy as np
+from datetime import datetime, timedelta
+import mktdata
+from mktdata import _AllFiels, _to_talib_format, get_mkt_data, FileMarketdata
+from helpers import talib_candlestick_funcs, stack_ohlc, find_pattern_event_matrix, load_symbols, mkdate
+from events import CandlestickPatternEvents
+from backtesting import StrategyRunner, load_strategies
+from outofcore import peak_rss
+
+
+SCENARIOS = ['ftse100', 'ftse250', 'ftse_small_cap', 'sp500']
+
+
+def _legacy_to_talib_format(mdata):
+    ''' Previous per-row np.append conversion, kept as a baseline '''
+    if len(mdata) == 0:
+        return None
+    res = {}
+    for x in _AllFiels:
+        res[x] = np.array([])
+    for md in mdata:
+        for x in _AllFiels:
+            res[x] = np.append(res[x], md[x])
+    return res
+
+
+def synthetic_rows(n, seed=0, start=datetime(1990, 1, 1), splits=2, dividends=8):
+    '''
+    Generates n daily market data rows in access.get_marketdata format.
+    Splits and dividends are injected, so close and adj_close diverge like in real data.
+    '''
+    rs = np.random.RandomState(seed)
+    close = 10.0 * np.exp(np.cumsum(rs.normal(0.0002, 0.015, n)))
+    open = np.r_[close[0], close[:-1]] * (1 + rs.normal(0, 0.004, n))
+    high = np.maximum(open, close) * (1 + np.abs(rs.normal(0, 0.008, n)))
+    low = np.minimum(open, close) * (1 - np.abs(rs.normal(0, 0.008, n)))
+    adj = np.ones(n)
+    for k in rs.randint(1, n, splits):
+        ratio = rs.choice([2.0, 3.0])
+        for x in (open, high, low, close):
+            x[:k] *= ratio  # prices before split are not adjusted
+        adj[:k] /= ratio
+    for k in rs.randint(1, n, dividends):
+        adj[:k] *= 1 - rs.uniform(0.005, 0.03)
+    dates = [start + timedelta(days=i) for i in range(n)]
+    return [{'date': dates[i], 'open': open[i], 'high': high[i], 'low': low[i], 'close': close[i], 'adj_close': close[i] * adj[i]} for i in range(n)]
+
+
+class SyntheticMarketdata(object):
+    ''' Marketdata source for mktdata.set_marketdata_source, rows are generated once per symbol and seeded by symbol name '''
+    def __init__(self, seed=0):
+        self._seed = seed
+        self._rows = {}
+        self.cache_id = 'synthetic-%d' % seed
+
+    def __call__(self, symbol, from_date, to_date):
+        key = (symbol, from_date, to_date)
+        if key not in self._rows:
+            seed = (self._seed + zlib.crc32(symbol)) & 0x7fffffff
+            self._rows[key] = synthetic_rows((to_date - from_date).days + 1, seed, from_date)
+        return self._rows[key]
+
+
+def _measure(name, scenario, func, nsymbols):
+    start = time.time()
+    items = func()
+    elapsed = time.time() - start
+    res = {'scenario': scenario, 'stage': name, 'symbols': nsymbols, 'items': items, 'seconds': elapsed,
+           'symbols_per_sec': nsymbols / elapsed if elapsed > 0 else 0.0, 'items_per_sec': items / elapsed if elapsed > 0 else 0.0,
+           'peak_rss_mb': peak_rss() / 2.0 ** 20}
+    print('%-15s %-10s %5d symbols %8d items %9.3fs %9.1f symbols/s %11.1f items/s peak %7.1f MB' % (
+        scenario, name, nsymbols, items, elapsed, res['symbols_per_sec'], res['items_per_sec'], res['peak_rss_mb']))
+    return res
+
+
+def bench_scenario(scenario, from_date, to_date, strategies, seed):
+    '''
+    Runs data loading, pattern search, events and backtesting stages over symbols of idx/<scenario>.dat.
+    Items are bars for load stage, pattern events for patterns and events stages, transactions for backtesting stage.
+    '''
+    symbols = list(load_symbols(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'idx', scenario + '.dat')))
+    palg = talib_candlestick_funcs()
+    mktdata.set_cache_dir(None)
+    mktdata.set_marketdata_source(SyntheticMarketdata(seed))
+    try:
+        for s in symbols:
+            mktdata._get_marketdata(s, from_date, to_date)  # generate rows outside of measurements
+
+        def load():
+            return sum(len(get_mkt_data(s, from_date, to_date)['open']) for s in symbols)  # items are bars
+
+        def patterns():
+            (block, lengths) = stack_ohlc([get_mkt_data(s, from_date, to_date) for s in symbols])
+            return len(find_pattern_event_matrix(block, lengths, palg))
+
+        def events():
+            c = CandlestickPatternEvents(symbols, palg, from_date, to_date)()
+            return sum(val.cnt() for (_, val) in c.average_changes)
+
+        def backtesting():
+            return sum(len(StrategyRunner(*x)(symbols, from_date, to_date).txns) for x in strategies)
+
+        return [_measure(name, scenario, func, len(symbols)) for (name, func) in [('load', load), ('patterns', patterns), ('events', events), ('backtesting', backtesting)]]
+    finally:
+        mktdata.set_marketdata_source(None)
+
+
+def bench_prefetch(scenario, from_date, to_date, seed, latency, depths):
+    '''
+    Runs events stage over local file backed marketdata with simulated db latency for every prefetch depth,
+    shows how much of loading is overlapped with pattern computation. Items are pattern events.
+    '''
+    symbols = list(load_symbols(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'idx', scenario + '.dat')))
+    palg = talib_candlestick_funcs()
+    path = tempfile.mkdtemp()
+    mktdata.set_cache_dir(None)
+    try:
+        files = FileMarketdata(path)
+        synthetic = SyntheticMarketdata(seed)
+        for s in symbols:
+            files.save(s, synthetic(s, from_date, to_date))
+        res = []
+        for depth in depths:
+            mktdata.set_prefetch(depth)
+            mktdata.set_marketdata_source(FileMarketdata(path, latency))  # also drops in-process cache
+
+            def events():
+                c = CandlestickPatternEvents(symbols, palg, from_date, to_date)()
+                return sum(val.cnt() for (_, val) in c.average_changes)
+            res.append(_measure('prefetch%d' % depth, scenario, events, len(symbols)))
+        return res
+    finally:
+        mktdata.set_marketdata_source(None)
+        mktdata.set_prefetch(4)
+        shutil.rmtree(path)
+
+
+def bench_to_talib_format(sizes, legacy_limit):
+    res = []
+    for n in sizes:
+        rows = synthetic_rows(n)
+        t = min(timeit.repeat(lambda: _to_talib_format(rows), number=1, repeat=3))
+        t_old = min(timeit.repeat(lambda: _legacy_to_talib_format(rows), number=1, repeat=1)) if n <= legacy_limit else None
+        print('_to_talib_format %7d rows: %9.4fs, legacy %s' % (n, t, '%9.4fs (x%.1f)' % (t_old, t_old / t) if t_old else 'skipped'))
+        res.append({'scenario': 'rows%d' % n, 'stage': 'to_talib_format', 'items': n, 'seconds': t, 'legacy_seconds': t_old})
+    return res
+
+
+def compare(res, fname):
+    ''' Prints time ratios against results saved by previous run '''
+    with open(fname) as f:
+        old = dict(((x['scenario'], x['stage']), x) for x in json.load(f)['results'])
+    for x in res:
+        key = (x['scenario'], x['stage'])
+        if key in old and old[key]['seconds'] > 0:
+            print('%-15s %-15s %9.3fs -> %9.3fs (x%.2f)' % (key[0], key[1], old[key]['seconds'], x['seconds'], x['seconds'] / old[key]['seconds']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Candlesticks benchmarks on synthetic market data')
+    parser.add_argument('-s', '--scenario', choices=SCENARIOS, nargs='+', default=['ftse100'], help='symbols universe from idx/')
+    parser.add_argument('-f', '--fromdate', metavar='YYYYMMDD', type=mkdate, default=datetime(2004, 1, 1), help='from date in format YYYYMMDD')
+    parser.add_argument('-t', '--todate', metavar='YYYYMMDD', type=mkdate, default=datetime(2013, 12, 31), help='to date in format YYYYMMDD')
+    parser.add_argument('--strategies', metavar='FILENAME', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'strategies.dat'), help='strategies for backtesting stage')
+    parser.add_argument('--seed', metavar='N', type=int, default=0, help='synthetic data seed')
+    parser.add_argument('--format-sizes', metavar='N', type=int, nargs='*', help='only benchmark _to_talib_format against previous implementation for N rows (1000 10000 100000 if empty)')
+    parser.add_argument('--legacy-limit', metavar='N', type=int, default=100000, help='skip previous _to_talib_format implementation above N rows')
+    parser.add_argument('--prefetch-depths', metavar='N', type=int, nargs='*', help='only benchmark events over file backed marketdata for prefetch depths N (0 4 if empty)')
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0.01, help='simulated marketdata db latency for --prefetch-depths')
+    parser.add_argument('-o', '--output', metavar='FILENAME', type=str, help='write results as json')
+    parser.add_argument('-c', '--compare', metavar='FILENAME', type=str, help='compare with results json of previous run')
+
+    args = parser.parse_args()
+    if args.format_sizes is not None:
+        res = bench_to_talib_format(args.format_sizes or [1000, 10000, 100000], args.legacy_limit)
+    elif args.prefetch_depths is not None:
+        res = []
+        for x in args.scenario:
+            res += bench_prefetch(x, args.fromdate, args.todate, args.seed, args.latency, args.prefetch_depths or [0, 4])
+    else:
+        res = []
+        for x in args.scenario:
+            res += bench_scenario(x, args.fromdate, args.todate, load_strategies(args.strategies), args.seed)
+    if args.compare:
+        compare(res, args.compare)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(), 'fromdate': args.fromdate.isoformat(), 'todate': args.todate.isoformat(),
+                       'seed': args.seed, 'results': res}, f, indent=1)
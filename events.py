@@ -4,32 +4,71 @@
 Candlestick events analyzer
 '''
 import os
+import json
+import time
+import zlib
+import shutil
+import tempfile
 import argparse
-from helpers import talib_candlestick_funcs, load_symbols, save_candlestick_chart, find_candlestick_patterns, create_result_dir, mkdate
-from mktdata import MktTypes, init_marketdata, get_mkt_data, has_split_dividents, odd_data
+import numpy as np
+import profiling
+import resultcache
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from helpers import talib_candlestick_funcs, load_symbols, stack_ohlc, find_pattern_event_matrix, matrix_pattern_events, create_result_dir, create_table, mkdate
+from outofcore import peak_rss, symbol_chunks, spill_columns, merge_spilled, save_spilled_npz, load_npz
+from mktdata import MktTypes, init_marketdata, get_mkt_data, prefetch_mkt_data, split_dividents_mask, odd_data_mask, window_matrix
+from backtesting import HOLD_DAYS, BUY_SIDES, LIMITS
 
 
 class AverageChange(object):
     ''' Class for calculating normalized average values '''
     def __init__(self, size):
-        self._dict = {}
-        for x in MktTypes:
-            self._dict[x] = [(0, 0)] * size
+        self._types = dict((x, i) for (i, x) in enumerate(MktTypes))
+        self._sum = np.zeros((len(MktTypes), size))
+        self._cnt = np.zeros((len(MktTypes), size), dtype=np.int64)
 
     def add_item(self, type, idx, relative_val, val):
-        acc = self._dict[type][idx][0] + float(val)/relative_val
-        cnt = self._dict[type][idx][1] + 1
-        self._dict[type][idx] = (acc, cnt)
+        t = self._types[type]
+        self._sum[t, idx] += float(val)/relative_val
+        self._cnt[t, idx] += 1
 
     def add(self, type, relative_val, vals):
-        for idx, val in enumerate(vals):
-            self.add_item(type, idx, relative_val, val)
+        t = self._types[type]
+        vals = np.asarray(vals, dtype=np.float64)
+        self._sum[t, :len(vals)] += vals/relative_val
+        self._cnt[t, :len(vals)] += 1
+
+    def add_batch(self, type, relative_vals, vals, lengths=None):
+        '''
+        Adds many windows at once
+        relative_vals - array with relative value for each window
+        vals - (windows x days) matrix
+        lengths - optional number of valid days in each window, rest of the row is ignored
+        '''
+        t = self._types[type]
+        vals = np.asarray(vals, dtype=np.float64) / np.asarray(relative_vals, dtype=np.float64)[:, None]
+        days = vals.shape[1]
+        if lengths is not None:
+            valid = np.arange(days) < np.asarray(lengths)[:, None]
+            vals = np.where(valid, vals, 0)
+            self._cnt[t, :days] += valid.sum(axis=0)
+        else:
+            self._cnt[t, :days] += vals.shape[0]
+        self._sum[t, :days] += vals.sum(axis=0)
+
+    def merge(self, other):
+        ''' Adds values accumulated by other AverageChange of the same size '''
+        self._sum += other._sum
+        self._cnt += other._cnt
 
     def average(self, type):
-        return [acc/cnt for (acc, cnt) in self._dict[type] if cnt > 0]
+        t = self._types[type]
+        filled = self._cnt[t] > 0
+        return (self._sum[t][filled] / self._cnt[t][filled]).tolist()
 
     def cnt(self):
-        return self._dict['open'][0][1]
+        return int(self._cnt[0, 0])
 
     def __repr__(self):
         val = ['%s: %s' % (x, str(self.average(x))) for x in MktTypes]
@@ -37,57 +76,227 @@ class AverageChange(object):
 
 
 CONSIDERED_NDAYS = 10
+EVENT_COLUMNS = ['symbol', 'pattern', 'value', 'date', 'length', 'window']  # per event columns of event table
 
 
 class CandlestickPatternEvents(object):
-    ''' Class for finding candlestick pattern events and counting average changes. '''
-    def __init__(self, symbols, candlestick_funcitons, from_date, to_date):
+    '''
+    Class for finding candlestick pattern events and counting average changes.
+    Symbols are processed independently (by a pool of workers if workers > 1) and merged in symbols order,
+    so results do not depend on number of workers.
+    '''
+    def __init__(self, symbols, candlestick_funcitons, from_date, to_date, workers=1, details=False, chunk_size=None, memory_limit=None, spill_dir=None):
+        '''
+        details - keep every accepted event with its normalized window, see save_event_table
+        chunk_size - out-of-core mode: symbols are processed in chunks (see symbol_chunks),
+                     details of every chunk are spilled to spill_dir directory,
+                     temporary directory removed by close if spill_dir is not given
+        '''
         self._symbols = symbols
         self._avgs = {}
         self._palg = candlestick_funcitons
         self._from_date = from_date
         self._to_date = to_date
+        self._workers = workers
+        self._details = [] if details else None
+        self._chunk_size = chunk_size
+        self._memory_limit = memory_limit
+        self._spill_dir = spill_dir
+        self._own_spill_dir = spill_dir is None
+        self._spilled = 0  # number of chunks spilled
 
     def __get_average_changes(self):
         for k in self._avgs.keys():
             yield (k, self._avgs[k])
     average_changes = property(__get_average_changes)
 
-    def _process_patterns(self, res, mdata, alg):
-        for (idx, val) in res:
-            try:
-                mdata_len = len(mdata['open'])
-                open_idx = min(idx + 1, mdata_len - 1)
-                close_idx = min(idx + 1 + CONSIDERED_NDAYS, mdata_len - 1)
-
-                if close_idx - open_idx < CONSIDERED_NDAYS / 2:
-                    continue  # skip events if we don't have enough days
-
-                if has_split_dividents(mdata, max(open_idx - 5, 0), close_idx):
-                    continue  # skip events if split/dividents happens
-
-                if odd_data(mdata['open'][open_idx], mdata['open'][close_idx]):
-                    continue  # skip odd market data
-
-                #TODO: output detail values for each event to file, plus index for comparison
-                next_day_open = mdata['open'][open_idx]
-                for m in MktTypes:
-                    key = '%s:%d' % (alg, val)
-                    if key not in self._avgs:
-                        self._avgs[key] = AverageChange(CONSIDERED_NDAYS)
-                    self._avgs[key].add(m, next_day_open, mdata[m][open_idx:close_idx])
-            except:
-                pass
+    @profiling.timed('aggregate', lambda self, res, mdata, alg, avgs, details=None: alg)
+    def _process_patterns(self, res, mdata, alg, avgs, details=None):
+        '''
+        res - pattern events (indexes, values)
+        avgs - dictionary with average changes to update
+        details - optional list to append (alg, value, dates, lengths, normalized windows) of accepted events
+        '''
+        (idxs, vals) = res
+        mdata_len = len(mdata['open'])
+        open_idx = np.minimum(idxs + 1, mdata_len - 1)
+        close_idx = np.minimum(idxs + 1 + CONSIDERED_NDAYS, mdata_len - 1)
+
+        valid = close_idx - open_idx >= CONSIDERED_NDAYS / 2  # skip events if we don't have enough days
+        valid &= ~split_dividents_mask(mdata, np.maximum(open_idx - 5, 0), close_idx)  # skip events if split/dividents happens
+        valid &= ~odd_data_mask(mdata['open'][open_idx], mdata['open'][close_idx])  # skip odd market data
+
+        (uvals, first) = np.unique(vals[valid], return_index=True)
+        for val in uvals[np.argsort(first)]:  # in order of appearance
+            sel = valid & (vals == val)
+            key = '%s:%d' % (alg, val)
+            if key not in avgs:
+                avgs[key] = AverageChange(CONSIDERED_NDAYS)
+            next_day_open = mdata['open'][open_idx[sel]]
+            lengths = close_idx[sel] - open_idx[sel]
+            windows = [window_matrix(mdata[m], open_idx[sel], close_idx[sel], CONSIDERED_NDAYS) for m in MktTypes]
+            for (m, w) in zip(MktTypes, windows):
+                avgs[key].add_batch(m, next_day_open, w, lengths)
+            if details is not None:
+                filled = np.arange(CONSIDERED_NDAYS)[None, None, :] < lengths[:, None, None]
+                windows = np.where(filled, np.stack(windows, axis=1) / next_day_open[:, None, None], np.nan)
+                details.append((alg, val, mdata['date'][idxs[sel]], lengths, windows))
+
+    def _process_symbol(self, symbol, mdata):
+        '''
+        Returns partial average changes of all patterns for the symbol, in order of first appearance,
+        and accepted events details (None if details are not kept)
+        '''
+        avgs = OrderedDict()
+        details = [] if self._details is not None else None
+        if mdata:
+            key = resultcache.make_key(symbol, resultcache.data_hash(mdata), self._from_date, self._to_date, CONSIDERED_NDAYS) if resultcache.enabled() else None
+            cached = (resultcache.load('events', key) if key else None) or {}
+            missing = [a for a in self._palg if a not in cached or (details is not None and cached[a][1] is None)]  # details are kept only if they were requested
+            (block, lengths) = stack_ohlc([mdata])
+            matrix = find_pattern_event_matrix(block, lengths, missing)
+            for (p, a) in enumerate(missing):
+                cached[a] = (OrderedDict(), [] if details is not None else None)
+                self._process_patterns(matrix_pattern_events(matrix, 0, p), mdata, a, cached[a][0], cached[a][1])
+            for a in self._palg:
+                avgs.update(cached[a][0])  # keys are unique per pattern, so order is the same as without cache
+                if details is not None:
+                    details.extend(cached[a][1])
+            if key and missing:
+                resultcache.save('events', key, cached)
+        return (avgs, details)
+
+    def _merge(self, avgs):
+        for (k, val) in avgs.items():
+            if k not in self._avgs:
+                self._avgs[k] = AverageChange(CONSIDERED_NDAYS)
+            self._avgs[k].merge(val)
 
     def __call__(self):
-        for s in self._symbols:
-            mdata = get_mkt_data(s, self._from_date, self._to_date)
-            if mdata:
-                for a in self._palg:
-                    res = find_candlestick_patterns(a, mdata)
-                    self._process_patterns(res, mdata, a)
+        pool = Pool(self._workers) if self._workers > 1 else None
+        chunks = symbol_chunks(self._symbols, self._chunk_size, self._memory_limit) if self._chunk_size else [self._symbols]
+        offset = 0
+        for chunk in chunks:
+            if pool is not None:
+                partials = pool.imap(profiling.Job(symbol_events), [(s, self._palg, self._from_date, self._to_date, self._details is not None) for s in chunk])
+            else:
+                partials = ((self._process_symbol(s, mdata), {}) for (s, mdata) in prefetch_mkt_data(chunk, self._from_date, self._to_date))
+            for (i, ((avgs, details), stats)) in enumerate(partials, offset):
+                self._merge(avgs)
+                if details:
+                    self._details.extend((i,) + x for x in details)
+                profiling.merge(stats)
+            offset += len(chunk)
+            if self._chunk_size and self._details is not None:
+                if self._spill_dir is None:
+                    self._spill_dir = tempfile.mkdtemp(prefix='events-spill-')
+                spill_columns(self._spill_dir, self._spilled, self._detail_columns())
+                self._spilled += 1
+                self._details = []
+        if pool is not None:
+            pool.close()
+            pool.join()
         return self
 
+    def close(self):
+        ''' Removes spilled details of temporary spill directory, event table is not available after it '''
+        if self._own_spill_dir and self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir)
+            self._spill_dir = None
+            self._spilled = 0
+
+    def _detail_columns(self):
+        ''' Event table columns of details kept in memory '''
+        palg = list(self._palg)
+        d = self._details
+        n = [len(x[3]) for x in d]
+        return dict(symbol=np.repeat(np.array([x[0] for x in d], dtype=np.int32), n),
+                    pattern=np.repeat(np.array([palg.index(x[1]) for x in d], dtype=np.int32), n),
+                    value=np.repeat(np.array([x[2] for x in d], dtype=np.int32), n),
+                    date=np.concatenate([x[3] for x in d] + [np.empty(0, dtype='datetime64[D]')]),
+                    length=np.concatenate([x[4] for x in d] + [np.empty(0, dtype=np.int64)]).astype(np.int8),
+                    window=np.concatenate([x[5] for x in d] + [np.empty((0, len(MktTypes), CONSIDERED_NDAYS))]))
+
+    def _names_columns(self):
+        return dict(symbols=np.array(self._symbols, dtype=str), patterns=np.array(list(self._palg), dtype=str))
+
+    def event_table_columns(self):
+        '''
+        Columns of accepted events kept with details=True, see EventTable.
+        Spilled chunks are merged to memory mapped columns valid until close.
+        '''
+        res = self._names_columns()
+        if self._spilled:
+            res.update((k, merge_spilled(self._spill_dir, self._spilled, k)) for k in EVENT_COLUMNS)
+        else:
+            res.update(self._detail_columns())
+        return res
+
+    def save_event_table(self, fname):
+        ''' Saves accepted events kept with details=True, see EventTable '''
+        if self._spilled:
+            save_spilled_npz(fname, self._spill_dir, self._spilled, EVENT_COLUMNS, self._names_columns())
+            return
+        with open(fname, 'wb') as f:
+            np.savez(f, **self.event_table_columns())
+
+
+def symbol_events((symbol, candlestick_funcitons, from_date, to_date, details)):
+    ''' Pool job: partial average changes and events details for one symbol '''
+    return CandlestickPatternEvents([symbol], candlestick_funcitons, from_date, to_date, details=details)._process_symbol(symbol, get_mkt_data(symbol, from_date, to_date))
+
+
+class EventTable(object):
+    '''
+    Accepted pattern events saved by CandlestickPatternEvents.save_event_table.
+    Columns: symbol, pattern (ids in symbols/patterns), value, date, length (days in window)
+    and window (events x MktTypes x CONSIDERED_NDAYS prices normalized by next day open, NaN after length).
+    Rows are in scan order (by symbol), index by pattern gives rows of a pattern without scanning the table.
+    '''
+    def __init__(self, source):
+        '''
+        source - events.npz file name (columns are memory mapped) or columns returned by CandlestickPatternEvents.event_table_columns
+        '''
+        d = load_npz(source) if isinstance(source, basestring) else source
+        self.symbols = list(d['symbols'])
+        self.patterns = list(d['patterns'])
+        (self.symbol, self.pattern, self.value, self.date, self.length, self.window) = [d[x] for x in EVENT_COLUMNS]
+        self._by_pattern = np.argsort(self.pattern, kind='mergesort')
+        self._pattern_bounds = np.searchsorted(self.pattern[self._by_pattern], np.arange(len(self.patterns) + 1))
+        self._symbol_bounds = np.searchsorted(self.symbol, np.arange(len(self.symbols) + 1))
+
+    def rows(self, pattern=None, symbols=None):
+        ''' Indexes of rows of pattern and/or symbols events, in scan order '''
+        res = np.arange(len(self.symbol))
+        if pattern is not None:
+            p = self.patterns.index(pattern)
+            res = np.sort(self._by_pattern[self._pattern_bounds[p]:self._pattern_bounds[p + 1]])
+        if symbols is not None:
+            res = np.concatenate([np.empty(0, dtype=res.dtype)] + [res[(res >= self._symbol_bounds[s]) & (res < self._symbol_bounds[s + 1])]
+                                                                   for s in sorted(self.symbols.index(x) for x in symbols)])
+        return res
+
+    def average_changes(self, rows=None, days=CONSIDERED_NDAYS):
+        '''
+        Average changes of events in rows (all by default) over first days of windows.
+        Events are added in the same order as by scan, so results are equal to CandlestickPatternEvents.average_changes.
+        '''
+        rows = np.arange(len(self.symbol)) if rows is None else rows
+        lengths = np.minimum(self.length, days)
+        res = {}
+        for s in np.unique(self.symbol[rows]):
+            srows = rows[self.symbol[rows] == s]
+            keys = ['%s:%d' % (self.patterns[p], v) for (p, v) in zip(self.pattern[srows], self.value[srows])]
+            for key in OrderedDict.fromkeys(keys):
+                krows = srows[np.array(keys) == key]
+                avg = AverageChange(days)
+                for (i, m) in enumerate(MktTypes):
+                    avg.add_batch(m, np.ones(len(krows)), self.window[krows, i, :days], lengths[krows])
+                if key not in res:
+                    res[key] = AverageChange(days)
+                res[key].merge(avg)
+        return res.items()
+
 
 def filter_average_changes(average_changes, diff_level, min_cnt):
     for (k, val) in average_changes:
@@ -100,7 +309,130 @@ def filter_average_changes(average_changes, diff_level, min_cnt):
             yield (k, val)
 
 
-def output_results(average_changes, params):
+SIGNIFICANCE_SAMPLES = 10000
+_SAMPLES_BATCH_ITEMS = 4000000  # resampled items per batch, bounds memory of one batch
+
+
+def event_returns(window, length, days=CONSIDERED_NDAYS):
+    ''' Close of the last day of event windows (first days) relative to next day open, minus 1 '''
+    last = np.minimum(length, days).astype(np.int64) - 1
+    return window[np.arange(len(last)), MktTypes.index('close'), last] - 1
+
+
+def symbol_baseline((symbol, from_date, to_date)):
+    ''' Pool job: event_returns of random entries, i.e. of every bar of the symbol passing events filters '''
+    mdata = get_mkt_data(symbol, from_date, to_date)
+    details = []
+    if mdata:
+        n = len(mdata['open'])
+        CandlestickPatternEvents([symbol], [], from_date, to_date)._process_patterns((np.arange(n), np.ones(n, dtype=np.int32)), mdata, 'BASELINE', OrderedDict(), details)
+    return np.concatenate([event_returns(x[4], x[3]) for x in details] + [np.empty(0)])
+
+
+def pattern_significance((key, returns, pools, samples, seed)):
+    '''
+    Pool job: bootstrap significance of pattern mean return.
+    returns - event_returns of pattern events, pools - [(random entry returns of symbol, number of pattern events in symbol), ...]
+    Null distribution is the mean of the same number of random entries per symbol, confidence interval (95%) is
+    bootstrapped from pattern events. Samples are drawn in batches, random state is seeded by seed and key.
+    Returns (key, events, mean return, random entry mean return, p-value, ci low, ci high)
+    '''
+    rs = np.random.RandomState((seed + zlib.crc32(key)) & 0x7fffffff)
+    n = len(returns)
+    mean = returns.mean()
+    baseline = sum(cnt * pool.mean() for (pool, cnt) in pools) / n
+    null = np.zeros(samples)
+    boot = np.empty(samples)
+    batch = max(1, _SAMPLES_BATCH_ITEMS / n)
+    for lo in range(0, samples, batch):
+        hi = min(lo + batch, samples)
+        for (pool, cnt) in pools:
+            null[lo:hi] += pool[rs.randint(0, len(pool), (hi - lo, cnt))].sum(axis=1)
+        boot[lo:hi] = returns[rs.randint(0, n, (hi - lo, n))].mean(axis=1)
+    null /= n
+    p_value = (1 + np.count_nonzero(np.abs(null - baseline) >= abs(mean - baseline))) / float(samples + 1)
+    (ci_low, ci_high) = np.percentile(boot, [2.5, 97.5])
+    return (key, n, mean, baseline, p_value, ci_low, ci_high)
+
+
+def pattern_significances(table, keys, from_date, to_date, samples=SIGNIFICANCE_SAMPLES, seed=0, workers=1):
+    '''
+    Tests patterns keys ('alg:value') of EventTable against random entries into the same symbols,
+    random entry returns are computed once per symbol. Work is spread over pool of workers,
+    results don't depend on number of workers.
+    Returns pattern_significance rows ordered by p-value and confidence interval width.
+    '''
+    returns = event_returns(table.window, table.length)
+    events = []
+    for key in keys:
+        (alg, val) = key.split(':')
+        rows = table.rows(alg)
+        rows = rows[table.value[rows] == int(val)]
+        events.append((key, returns[rows], np.bincount(table.symbol[rows], minlength=len(table.symbols))))
+    symbols = sorted(set(s for (_, _, counts) in events for s in np.flatnonzero(counts)))
+    pool = Pool(workers) if workers > 1 else None
+    baseline_jobs = [(table.symbols[s], from_date, to_date) for s in symbols]
+    baselines = dict(zip(symbols, _map_jobs(pool, symbol_baseline, baseline_jobs)))
+    jobs = [(key, r, [(baselines[s], counts[s]) for s in np.flatnonzero(counts)], samples, seed) for (key, r, counts) in events]
+    res = list(_map_jobs(pool, pattern_significance, jobs))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return sorted(res, key=lambda x: (x[4], x[6] - x[5]))
+
+
+def _map_jobs(pool, func, jobs):
+    ''' Results of func over jobs in jobs order, in pool if given '''
+    if pool is None:
+        for x in jobs:
+            yield func(x)
+    else:
+        for (res, stats) in pool.imap(profiling.Job(func), jobs):
+            profiling.merge(stats)
+            yield res
+
+
+def output_significance(outpath, rows):
+    with open(os.path.join(outpath, 'significance.html'), 'w') as f:
+        create_table(f, ['Pattern', 'Events', 'Mean return', 'Random entry mean return', 'p-value', 'CI low', 'CI high'], rows,
+                     ['%s', '%d', '%f', '%f', '%f', '%f', '%f'])
+
+
+CHARTS = ['deferred', 'lazy', 'none']
+
+
+def render_chart((fname, quotes)):
+    from rendering import save_candlestick_chart  # matplotlib is loaded only when charts are rendered
+    save_candlestick_chart(fname, quotes)
+
+
+def render_charts(outpath, charts, workers=1):
+    ''' Renders chart jobs [(image name, quotes), ...] in a pool of workers '''
+    jobs = [(os.path.join(outpath, img_name), quotes) for (img_name, quotes) in charts]
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(min(workers, len(jobs)))
+        for (_, stats) in pool.imap_unordered(profiling.Job(render_chart), jobs):
+            profiling.merge(stats)
+        pool.close()
+        pool.join()
+    else:
+        map(render_chart, jobs)
+
+
+def render_saved_charts(outpath, workers=1):
+    ''' Renders charts saved by output_results in lazy mode '''
+    with open(os.path.join(outpath, 'charts.json')) as f:
+        charts = json.load(f)
+    render_charts(outpath, charts, workers)
+    os.remove(os.path.join(outpath, 'charts.json'))
+
+
+def output_results(average_changes, params, charts='deferred', workers=1):
+    '''
+    charts - deferred: render charts by pool of workers after all text output is written,
+             lazy: only save chart jobs to charts.json, see render_saved_charts,
+             none: skip charts
+    '''
     outpath = create_result_dir('events')
 
     with open(os.path.join(outpath, 'params.txt'), 'w') as f:
@@ -110,11 +442,12 @@ def output_results(average_changes, params):
 
     with open(os.path.join(outpath, 'strategies.dat'), 'w') as f:
         for (k, v) in average_changes:
-            for days in [1, 2, 3, 5, 9]:
-                for buy in [0, 1]:
-                    for limit in [0.01, 0.015, 0.02, 0.03, 0.05]:
+            for days in HOLD_DAYS:
+                for buy in BUY_SIDES:
+                    for limit in LIMITS:
                         f.write(','.join(k.split(':') + [str(days), str(buy), str(limit)]) + '\n')
 
+    chart_jobs = []
     with open(os.path.join(outpath, 'events.html'), 'w') as f:
         i = 0
         for (k, val) in average_changes:
@@ -122,39 +455,110 @@ def output_results(average_changes, params):
             f.write('<b>Number of events: %d</b><br/>' % val.cnt())
             f.write('</br><code>%s</code>' % repr(val).replace('<', '&lt;').replace('>', '&gt;'))
             i += 1
-            val = [val.average(t) for t in [MktTypes[0], MktTypes[3], MktTypes[1], MktTypes[2]]]
-            days = [[x for x in range(len(val[0]))]]  # put fake dates
-            quotes = days + val
-            quotes = zip(*quotes)
-            img_name = '%s.png' % k
-            save_candlestick_chart(os.path.join(outpath, img_name), quotes)
-            f.write('<img src="./%s"/>' % img_name)
+            if charts != 'none':
+                val = [val.average(t) for t in [MktTypes[0], MktTypes[3], MktTypes[1], MktTypes[2]]]
+                days = [[x for x in range(len(val[0]))]]  # put fake dates
+                quotes = days + val
+                quotes = zip(*quotes)
+                img_name = '%s.png' % k
+                chart_jobs.append((img_name, quotes))
+                f.write('<img src="./%s"/>' % img_name)
             f.write('<hr/>')
         f.write('<b>Total: %d</b>' % i)
 
-
-def events_main(fname, from_date, to_date):
+    if charts == 'lazy':
+        with open(os.path.join(outpath, 'charts.json'), 'w') as f:
+            json.dump(chart_jobs, f)
+    elif charts == 'deferred':
+        render_charts(outpath, chart_jobs, workers)
+
+    return outpath
+
+
+def events_main(fname, from_date, to_date, workers=1, profile=False, charts='deferred', details=False, significance=None, seed=0, chunk_size=None, memory_limit=None):
+    '''
+    details - save every accepted event to events.npz in results directory, see EventTable
+    significance - (samples, alpha): output only patterns with bootstrap p-value <= alpha, ordered by p-value,
+                   see pattern_significances. All tested patterns are written to significance.html.
+    chunk_size - out-of-core mode, symbols are processed in chunks and events details are spilled to disk,
+                 memory_limit (bytes) shrinks chunks, see symbol_chunks. Peak RSS is reported.
+    '''
+    start = time.time()
+    profiling.enable(profile)
     symbols = load_symbols(fname)
     init_marketdata(symbols, from_date, to_date)
 
     palg = talib_candlestick_funcs()
 
-    c = CandlestickPatternEvents(symbols, palg, from_date, to_date)()
+    c = CandlestickPatternEvents(symbols, palg, from_date, to_date, workers, details or significance is not None, chunk_size, memory_limit)()
 
     diff_level = 0.02  # output patterns where up/down > diff_level
     min_cnt = 10  # output patterns with > min_cnt events
 
     average_changes = list(filter_average_changes(c.average_changes, diff_level, min_cnt))
 
-    output_results(average_changes, [fname, from_date, to_date])
+    if significance is not None:
+        (samples, alpha) = significance
+        tested = pattern_significances(EventTable(c.event_table_columns()), [k for (k, _) in average_changes], from_date, to_date, samples, seed, workers)
+        candidates = dict(average_changes)
+        average_changes = [(x[0], candidates[x[0]]) for x in tested if x[4] <= alpha]
+
+    outpath = output_results(average_changes, [fname, from_date, to_date], charts, workers)
+    if significance is not None:
+        output_significance(outpath, tested)
+    if details:
+        c.save_event_table(os.path.join(outpath, 'events.npz'))
+    c.close()
+    if chunk_size:
+        print('Peak RSS: %d MB' % (peak_rss() / 2 ** 20))
+
+    if profile:
+        profiling.add('total', time.time() - start)
+        profiling.write_report(outpath)
+
+
+def table_main(fname, diff_level, min_cnt, days, charts='deferred', workers=1):
+    ''' Outputs results from event table saved by previous run, patterns are not recomputed '''
+    t = EventTable(fname)
+    average_changes = list(filter_average_changes(t.average_changes(days=days), diff_level, min_cnt))
+    output_results(average_changes, [fname, '', ''], charts, workers)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Candlestick events analyzer')
-    parser.add_argument('-f', '--fromdate', metavar='YYYYMMDD', type=mkdate, required=True, help='from date in format YYYYMMDD')
-    parser.add_argument('-t', '--todate', metavar='YYYYMMDD', type=mkdate, required=True, help='from date in format YYYYMMDD')
-    parser.add_argument('-s', '--shares', metavar='FILENAME', type=str, required=True, help='file with list of shares')
+    parser.add_argument('-f', '--fromdate', metavar='YYYYMMDD', type=mkdate, help='from date in format YYYYMMDD')
+    parser.add_argument('-t', '--todate', metavar='YYYYMMDD', type=mkdate, help='from date in format YYYYMMDD')
+    parser.add_argument('-s', '--shares', metavar='FILENAME', type=str, help='file with list of shares')
+    parser.add_argument('-w', '--workers', metavar='N', type=int, default=cpu_count(), help='number of worker processes, 1 runs serially')
+    parser.add_argument('--profile', action='store_true', help='write per stage timing report to results directory')
+    parser.add_argument('--charts', choices=CHARTS, default='deferred', help='render charts after text output (deferred), save them for --render-charts (lazy) or skip them (none)')
+    parser.add_argument('--significance', metavar='ALPHA', type=float, help='output only patterns with bootstrap p-value <= ALPHA against random entries, e.g. 0.05')
+    parser.add_argument('--samples', metavar='N', type=int, default=SIGNIFICANCE_SAMPLES, help='bootstrap samples for --significance')
+    parser.add_argument('--seed', metavar='N', type=int, default=0, help='random seed for --significance')
+    parser.add_argument('--no-charts', action='store_true', help='headless mode, same as --charts none')
+    parser.add_argument('--render-charts', metavar='RESULTS_DIR', type=str, help='render charts saved by --charts lazy run')
+    parser.add_argument('--details', action='store_true', help='save every accepted event to events.npz in results directory')
+    parser.add_argument('--table', metavar='EVENTS_NPZ', type=str, help='output results from events.npz of previous run without recomputing patterns')
+    parser.add_argument('--diff-level', metavar='X', type=float, default=0.02, help='with --table: output patterns where up/down > X')
+    parser.add_argument('--min-cnt', metavar='N', type=int, default=10, help='with --table: output patterns with >= N events')
+    parser.add_argument('--days', metavar='N', type=int, default=CONSIDERED_NDAYS, help='with --table: number of days after event')
+    parser.add_argument('--result-cache', metavar='DIR', type=str, default=resultcache.RESULT_CACHE_DIR, help='per symbol results cache, only symbols and patterns with changed inputs are recomputed')
+    parser.add_argument('--no-result-cache', action='store_true', help='recompute everything')
+    parser.add_argument('--chunk-size', metavar='N', type=int, help='out-of-core mode: process N symbols at a time, events details are spilled to disk')
+    parser.add_argument('--memory-limit', metavar='MB', type=int, help='with --chunk-size: halve chunks while resident memory exceeds MB (best-effort, not a hard ceiling)')
 
     args = parser.parse_args()
-    events_main(args.shares, args.fromdate, args.todate)
+    resultcache.set_result_cache_dir(None if args.no_result_cache else args.result_cache)
+    if args.no_charts:
+        args.charts = 'none'
+    if args.render_charts:
+        render_saved_charts(args.render_charts, args.workers)
+    elif args.table:
+        table_main(args.table, args.diff_level, args.min_cnt, args.days, args.charts, args.workers)
+    elif args.fromdate and args.todate and args.shares:
+        significance = (args.samples, args.significance) if args.significance is not None else None
+        events_main(args.shares, args.fromdate, args.todate, args.workers, args.profile, args.charts, args.details, significance, args.seed,
+                    args.chunk_size, args.memory_limit * 2 ** 20 if args.memory_limit else None)
+    else:
+        parser.error('-f/--fromdate, -t/--todate and -s/--shares are required')
 
@@ -4,12 +4,20 @@ Helper functions
 '''
 
 import os
+import tempfile
 import talib
+import talib.abstract
 import numpy as np
-import pylab as pl
-from matplotlib.dates import DateFormatter, WeekdayLocator, DayLocator, MONDAY
-from matplotlib.finance import candlestick
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import profiling
+
+
+_OHLC = ['open', 'high', 'low', 'close']
+_talib_funcs = {}  # cached talib function handles
+
+# sparse event matrix item: non zero result (value) of candlestick function (pattern) for symbol at bar
+EventDType = np.dtype([('symbol', np.int32), ('pattern', np.int32), ('bar', np.int32), ('value', np.int32)])
 
 
 def talib_candlestick_funcs():
@@ -17,41 +25,93 @@ def talib_candlestick_funcs():
     return [x for x in talib.get_functions() if 'CDL' in x]
 
 
-def talib_call(func, open, high, low, close):
-    f = getattr(talib, func)
-    return f(open, high, low, close)
+def talib_lookback(func):
+    ''' Number of previous bars candlestick function needs to produce a result '''
+    return talib.abstract.Function(func).lookback
 
 
-def find_candlestick_patterns(cfunc, mdata):
-    res = talib_call(cfunc, mdata['open'], mdata['high'], mdata['low'], mdata['close'])
-    return ((idx, val) for idx, val in enumerate(res) if val != 0)
+def talib_function(func):
+    ''' Cached talib function handle '''
+    f = _talib_funcs.get(func)
+    if f is None:
+        f = _talib_funcs[func] = getattr(talib, func)
+    return f
 
 
-def load_symbols(fname):
-    return np.loadtxt(fname, dtype='S10', comments='#', skiprows=0)
+@profiling.timed('talib', lambda func, *args: func)
+def talib_call(func, open, high, low, close):
+    return talib_function(func)(open, high, low, close)
 
 
-def save_candlestick_chart(fname, quotes):
+def stack_ohlc(mdatas):
+    '''
+    Stacks OHLC of many symbols to padded (symbols x bars) block, returns (block, lengths).
+    Missing market data (None) gives empty row, rows are NaN padded after their length.
     '''
-    quotes should have the following format: [(date1, open1, close1, high1, low1), (date2, open2, ...), (...), ...]
+    lengths = np.array([len(x['open']) if x else 0 for x in mdatas], dtype=np.int64)
+    width = lengths.max() if len(lengths) else 0
+    block = dict((x, np.full((len(mdatas), width), np.nan)) for x in _OHLC)
+    for (i, mdata) in enumerate(mdatas):
+        for x in _OHLC:
+            block[x][i, :lengths[i]] = mdata[x] if lengths[i] else []
+    return (block, lengths)
+
+
+def _row_events((block, i, n, cfuncs)):
+    ''' Non zero results of candlestick functions for one block row: [(pattern, indexes, values), ...] '''
+    (open, high, low, close) = [block[x][i, :n] for x in _OHLC]
+    res = []
+    for (p, cfunc) in enumerate(cfuncs):
+        out = talib_call(cfunc, open, high, low, close)
+        idx = np.flatnonzero(out)
+        res.append((p, idx, out[idx]))
+    return res
+
+
+def find_pattern_event_matrix(block, lengths, cfuncs, threads=1):
     '''
-    mondays = WeekdayLocator(MONDAY)
-    alldays = DayLocator()
-    weekFormatter = DateFormatter('%b %d')
+    Evaluates candlestick functions over all rows of OHLC block (see stack_ohlc).
+    Returns sparse event matrix - EventDType array ordered by symbol, pattern and bar,
+    symbol and pattern are positions in block rows and cfuncs.
+    threads - evaluate rows in a thread pool, it pays off only with talib build releasing GIL
+    '''
+    jobs = [(block, i, n, cfuncs) for (i, n) in enumerate(lengths) if n > 0]
+    if threads > 1 and len(jobs) > 1:
+        pool = ThreadPool(threads)
+        rows = pool.map(_row_events, jobs)
+        pool.close()
+        pool.join()
+    else:
+        rows = [_row_events(x) for x in jobs]
+    res = np.empty(sum(len(idx) for row in rows for (_, idx, _) in row), dtype=EventDType)
+    pos = 0
+    for (job, row) in zip(jobs, rows):
+        for (p, idx, vals) in row:
+            items = res[pos:pos + len(idx)]
+            items['symbol'] = job[1]
+            items['pattern'] = p
+            items['bar'] = idx
+            items['value'] = vals
+            pos += len(idx)
+    return res
+
+
+def matrix_pattern_events(matrix, symbol, pattern):
+    ''' Events of one symbol and pattern in event matrix: (indexes, values) '''
+    (lo, hi) = np.searchsorted(matrix['symbol'], [symbol, symbol + 1])
+    items = matrix[lo:hi]
+    items = items[items['pattern'] == pattern]
+    return (items['bar'].astype(np.int64), items['value'])
+
 
-    fig = pl.figure()
-    fig.subplots_adjust(bottom=0.2)
-    ax = fig.add_subplot(111)
-    ax.xaxis.set_major_locator(mondays)
-    ax.xaxis.set_minor_locator(alldays)
-    ax.xaxis.set_major_formatter(weekFormatter)
+def find_candlestick_patterns(cfunc, mdata):
+    ''' (index, value) of non zero candlestick function results of one symbol, see find_pattern_event_matrix for many '''
+    (block, lengths) = stack_ohlc([mdata])
+    return ((int(x['bar']), int(x['value'])) for x in find_pattern_event_matrix(block, lengths, [cfunc]))
 
-    candlestick(ax, quotes, width=0.6, colorup='g')
-    ax.xaxis_date()
-    ax.autoscale_view()
-    pl.setp(pl.gca().get_xticklabels(), rotation=45, horizontalalignment='right')
 
-    pl.savefig(fname)
+def load_symbols(fname):
+    return np.loadtxt(fname, dtype='S10', comments='#', skiprows=0)
 
 
 def create_result_dir(name):
@@ -61,6 +121,23 @@ def create_result_dir(name):
     return outpath
 
 
+def atomic_write(path, write):
+    '''
+    Writes file by write(f) to temporary file next to path and renames it to path,
+    so concurrent readers never see partially written file. Missing directories are created.
+    '''
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            pass  # created by other process
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.rename(tmp, path)  # atomic
+
+
 def create_table(f, header, values, valueFormat):
     table_header(f, header)
     for x in values:
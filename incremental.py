@@ -0,0 +1,46 @@
+# coding:utf-8
+'''
+Incremental candlestick pattern detection for appended bars
+'''
+import numpy as np
+from helpers import talib_call, talib_lookback
+from mktdata import MktTypes
+
+
+class IncrementalPatternDetector(object):
+    '''
+    Keeps the last bars of every symbol needed by candlestick functions lookback.
+    Update runs candlestick functions over that tail plus new bars only, so it costs O(new bars), not O(history).
+    '''
+    def __init__(self, candlestick_funcitons):
+        self._palg = candlestick_funcitons
+        self._keep = max([talib_lookback(a) for a in candlestick_funcitons] + [1])
+        self._state = {}  # symbol -> (number of bars seen, tail of market data)
+
+    def bars(self, symbol):
+        ''' Number of bars seen for symbol '''
+        return self._state.get(symbol, (0, None))[0]
+
+    def copy(self):
+        ''' Copy which can be updated without changing this detector '''
+        res = IncrementalPatternDetector(self._palg)
+        res._state = dict(self._state)  # state of symbol is replaced on update, never changed in place
+        return res
+
+    def update(self, symbol, mdata):
+        '''
+        mdata - newly appended bars in talib format, first update may contain the whole history
+        Returns new events {alg: (indexes, values)}, indexes are positions in the full history of the symbol.
+        '''
+        new_bars = len(mdata['open'])
+        (nbars, tail) = self._state.get(symbol, (0, None))
+        if tail is not None:
+            mdata = dict((x, np.concatenate((tail[x], mdata[x]))) for x in MktTypes)
+        start = len(mdata['open']) - new_bars  # position of the first new bar in mdata
+        res = {}
+        for a in self._palg:
+            out = talib_call(a, mdata['open'], mdata['high'], mdata['low'], mdata['close'])[start:]
+            idx = np.flatnonzero(out)
+            res[a] = (idx + nbars, out[idx])
+        self._state[symbol] = (nbars + new_bars, dict((x, np.array(mdata[x][-self._keep:], dtype=np.float64)) for x in MktTypes))
+        return res
@@ -3,15 +3,36 @@
 Marketdata helpers
 '''
 
+import os
+import copy
+import time
+import shutil
+import threading
+import hashlib
 from functools32 import lru_cache
+from operator import itemgetter
+from itertools import islice
+from collections import deque
 import numpy as np
 from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
 from marketdata import update, access
 from marketdata.symbols import Symbols
+from helpers import atomic_write
+import profiling
 
 
 MktTypes = ['open', 'high', 'low', 'close']
 _AllFiels = ['date', 'adj_close'] + MktTypes
+_MktDType = np.dtype([('date', 'datetime64[D]')] + [(x, np.float64) for x in _AllFiels[1:]])
+
+_cache_dir = '.mktcache'  # on-disk marketdata cache, None disables it
+_shared = None  # SharedMktData used by get_mkt_data
+_source = None  # replaces access.get_marketdata, see set_marketdata_source
+_prefetch_depth = 4  # symbols loaded ahead by prefetch_mkt_data, 0 disables prefetching
+_prefetch_threads = 2
+_lru = threading.local()  # miss flag of _load_mkt_data call, see get_mkt_data
 
 
 def _check_db(symbols, from_date, to_date):
@@ -35,6 +56,7 @@ def _init_db(symbols, from_date, to_date):
     Symbols().clean()
     Symbols().add(symbols)
     update.update_marketdata(from_date, to_date)
+    clear_cache()
 
 
 def init_marketdata(symbols, from_date, to_date):
@@ -42,26 +64,301 @@ def init_marketdata(symbols, from_date, to_date):
         _init_db(symbols, from_date, to_date)
 
 
+def refresh_marketdata(from_date, to_date):
+    ''' Fetches bars from_date..to_date of all symbols in marketdata db and drops cached ranges which miss them '''
+    update.update_marketdata(from_date, to_date)
+    _drop_cached(from_date)
+
+
+def set_marketdata_source(source):
+    '''
+    Replaces marketdata db with source(symbol, from_date, to_date) returning rows in access.get_marketdata format,
+    e.g. synthetic data for benchmarks. None restores marketdata db.
+    On-disk cache of source is kept apart from other sources under source.cache_id, sources without it are not cached on disk.
+    '''
+    global _source
+    _source = source
+    _load_mkt_data.cache_clear()
+
+
+class FileMarketdata(object):
+    '''
+    Local file backed stand-in for marketdata db, one <symbol>.csv file (date,open,high,low,close,adj_close) per symbol.
+    Can be used with set_marketdata_source to run and benchmark offline,
+    latency - seconds added to every request to simulate db round trip.
+    '''
+    def __init__(self, path, latency=0.0):
+        self._path = path
+        self._latency = latency
+        self.cache_id = 'files-' + hashlib.sha1(os.path.abspath(path)).hexdigest()[:12]
+
+    def _fname(self, symbol):
+        return os.path.join(self._path, '%s.csv' % symbol)
+
+    def save(self, symbol, mdata):
+        ''' Writes market data in talib format (or rows in access.get_marketdata format) of symbol '''
+        mdata = _to_talib_format(mdata) if getattr(mdata, 'keys', None) is None else mdata
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+        with open(self._fname(symbol), 'w') as f:
+            f.write(','.join(_AllFiels) + '\n')
+            for row in zip(*[mdata[x] for x in _AllFiels]):
+                f.write('%s,%r,%r,%r,%r,%r\n' % ((str(row[0]),) + tuple(float(x) for x in row[1:])))
+
+    def __call__(self, symbol, from_date, to_date):
+        if self._latency:
+            time.sleep(self._latency)
+        if not os.path.exists(self._fname(symbol)):
+            return []
+        with open(self._fname(symbol)) as f:
+            f.readline()
+            rows = [x.rstrip('\n').split(',') for x in f]
+        res = np.empty(len(rows), dtype=_MktDType)
+        res['date'] = [x[0] for x in rows]
+        for (i, x) in enumerate(_AllFiels[1:], 1):
+            res[x] = [float(r[i]) for r in rows]
+        return res[(res['date'] >= np.datetime64(from_date, 'D')) & (res['date'] <= np.datetime64(to_date, 'D'))]
+
+
+@profiling.timed('db')
 def _get_marketdata(symbol, from_date, to_date):
+    if _source is not None:
+        return _source(symbol, from_date, to_date)
     return access.get_marketdata(symbol, from_date, to_date)
 
 
+@profiling.timed('format')
 def _to_talib_format(mdata):
-    ''' Converts market data to talib format '''
+    ''' Converts market data rows (or a structured array of them) to columnar talib format '''
     if len(mdata) == 0:
         return None
-    res = {}
-    for x in _AllFiels:
-        res[x] = np.array([])
-    for md in mdata:
-        for x in _AllFiels:
-            res[x] = np.append(res[x], md[x])
+    if getattr(mdata, 'dtype', None) is None or mdata.dtype.names is None:
+        row = itemgetter(*_AllFiels)
+        mdata = np.array([row(md) for md in mdata], dtype=_MktDType)
+    return dict((x, np.ascontiguousarray(mdata[x], dtype=_MktDType[x])) for x in _AllFiels)
+
+
+def set_cache_dir(path):
+    ''' Sets on-disk marketdata cache directory, None disables on-disk caching '''
+    global _cache_dir
+    _cache_dir = path
+    _load_mkt_data.cache_clear()
+
+
+def clear_cache():
+    ''' Drops on-disk and in-process marketdata caches, should be called when marketdata db is refreshed '''
+    if _cache_dir is not None and os.path.isdir(_cache_dir):
+        shutil.rmtree(_cache_dir, ignore_errors=True)
+    _load_mkt_data.cache_clear()
+
+
+def _drop_cached(from_date):
+    ''' Drops in-process cache and on-disk cache files of ranges ending at from_date or later '''
+    if _cache_dir is not None:
+        for (path, _, files) in os.walk(_cache_dir):
+            for x in files:
+                if x.endswith('.npy') and x[:-4].rsplit('_', 1)[-1] >= from_date.strftime('%Y%m%d'):
+                    try:
+                        os.remove(os.path.join(path, x))
+                    except OSError:
+                        pass  # removed by other process
+    _load_mkt_data.cache_clear()
+
+
+def load_bars(symbol, from_date, to_date):
+    ''' Market data straight from marketdata source, bypasses in-process and on-disk caches (e.g. a few new bars) '''
+    return _to_talib_format(_get_marketdata(symbol, from_date, to_date))
+
+
+def _source_cache_id():
+    ''' Directory of marketdata source in on-disk cache, None if source can't be cached '''
+    return 'db' if _source is None else getattr(_source, 'cache_id', None)
+
+
+def _cache_path(symbol, from_date, to_date):
+    return os.path.join(_cache_dir, _source_cache_id(), '%s_%s_%s.npy' % (symbol, from_date.strftime('%Y%m%d'), to_date.strftime('%Y%m%d')))
+
+
+def _to_block(mdata, block):
+    '''
+    Copies market data to (fields x days) float64 block, so every field is a contiguous row.
+    Dates are stored as raw datetime64 bits.
+    '''
+    block[0] = mdata['date'].astype(_MktDType['date']).view(np.float64)
+    for i, x in enumerate(_AllFiels[1:], 1):
+        block[i] = mdata[x]
+    return block
+
+
+def _from_block(block):
+    ''' Market data view of (fields x days) block, no data is copied '''
+    res = dict((x, block[i]) for i, x in enumerate(_AllFiels))
+    res['date'] = block[0].view(_MktDType['date'])
     return res
 
 
-@lru_cache(maxsize=32)
+def _save_cached(path, mdata):
+    ''' Saves market data as a single (fields x days) block '''
+    block = _to_block(mdata, np.empty((len(_AllFiels), len(mdata['date'])), dtype=np.float64))
+    atomic_write(path, lambda f: np.save(f, block))
+
+
+def _load_cached(path):
+    ''' Maps cached market data read-only, so processes share the same pages '''
+    return _from_block(np.load(path, mmap_mode='r'))
+
+
+class SharedMktData(object):
+    '''
+    Market data of many symbols in one contiguous (fields x bars) block of shared memory plus offsets of every symbol.
+    Should be created before Pool, workers inherit the block and use it without copying (see use_shared_mkt_data).
+    Copy made by mapped can be passed to workers of already running Pool.
+    '''
+    def __init__(self, symbols, from_date, to_date, data=None):
+        '''
+        data - [(symbol, market data), ...] to use instead of loading symbols
+        '''
+        self.from_date = from_date
+        self.to_date = to_date
+        if data is None:
+            data = prefetch_mkt_data(symbols, from_date, to_date)
+        data = [(s, x) for (s, x) in data if x]
+        self._symbols = [s for (s, _) in data]
+        self._fname = None  # file of mapped copy
+        self._map = None
+        self._raw = RawArray('d', len(_AllFiels) * max(sum(len(x['date']) for (_, x) in data), 1))
+        self._index = {}
+        block = self._block()
+        pos = 0
+        for (s, x) in data:
+            _to_block(x, block[:, pos:pos + len(x['date'])])
+            self._index[s] = (pos, pos + len(x['date']))
+            pos += len(x['date'])
+
+    def _block(self):
+        if self._fname is not None:
+            if self._map is None:
+                self._map = np.load(self._fname, mmap_mode='r')
+            return self._map
+        return np.frombuffer(self._raw, dtype=np.float64).reshape(len(_AllFiels), -1)
+
+    def mapped(self, fname):
+        '''
+        Copy backed by memory mapped file fname instead of shared memory. It is pickled without the block,
+        unpickled copy maps the same file, so processes share the block through page cache.
+        '''
+        np.save(fname, self._block())
+        res = copy.copy(self)
+        (res._raw, res._fname, res._map) = (None, fname, None)
+        return res
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_map'] = None
+        return state
+
+    def __contains__(self, symbol):
+        return symbol in self._index
+
+    def get(self, symbol):
+        (start, stop) = self._index[symbol]
+        block = self._block()[:, start:stop]  # every row is still contiguous
+        block.flags.writeable = False
+        return _from_block(block)
+
+    def extended(self, bars, to_date):
+        '''
+        Copy of market data up to to_date, bars - {symbol: market data of bars after its last bar} are appended.
+        Only new bars are loaded, the block itself is copied in memory.
+        '''
+        if not bars:
+            res = copy.copy(self)  # shares the block
+            res.to_date = to_date
+            return res
+
+        def data(s):
+            if s not in self:
+                return bars[s]
+            if s not in bars:
+                return self.get(s)
+            return dict((x, np.concatenate((self.get(s)[x], bars[s][x]))) for x in _AllFiels)
+        symbols = self._symbols + [s for s in bars.keys() if s not in self]  # new symbols in order of bars
+        return SharedMktData(symbols, self.from_date, to_date, [(s, data(s)) for s in symbols])
+
+
+def use_shared_mkt_data(shared):
+    ''' Makes get_mkt_data use SharedMktData, can be used as Pool initializer '''
+    global _shared
+    _shared = shared
+
+
 def get_mkt_data(symbol, from_date, to_date):
-    return _to_talib_format(_get_marketdata(symbol, from_date, to_date))
+    if _shared is not None and symbol in _shared and (_shared.from_date, _shared.to_date) == (from_date, to_date):
+        if profiling.enabled():
+            profiling.count('shared_hit')
+        return _shared.get(symbol)
+    if profiling.enabled():
+        _lru.miss = False  # set by _load_mkt_data running in this thread
+        res = _load_mkt_data(symbol, from_date, to_date)
+        profiling.count('lru_miss' if _lru.miss else 'lru_hit')
+        return res
+    return _load_mkt_data(symbol, from_date, to_date)
+
+
+def set_prefetch(depth, threads=2):
+    ''' Sets number of symbols loaded ahead by prefetch_mkt_data and its loader threads, depth 0 disables prefetching '''
+    global _prefetch_depth, _prefetch_threads
+    _prefetch_depth = depth
+    _prefetch_threads = threads
+
+
+def prefetch_mkt_data(symbols, from_date, to_date):
+    '''
+    Yields (symbol, market data) in symbols order, the same as get_mkt_data of every symbol.
+    Next symbols are loaded by a small thread pool while the current one is processed,
+    at most prefetch depth symbols are loaded ahead of the consumer (see set_prefetch).
+    '''
+    shared = _shared is not None and (_shared.from_date, _shared.to_date) == (from_date, to_date)
+    if _prefetch_depth <= 0 or len(symbols) < 2 or shared:  # nothing to overlap
+        for s in symbols:
+            yield (s, get_mkt_data(s, from_date, to_date))
+        return
+    pool = ThreadPool(max(min(_prefetch_threads, _prefetch_depth), 1))
+    try:
+        it = iter(symbols)
+        pending = deque((s, pool.apply_async(get_mkt_data, (s, from_date, to_date))) for s in islice(it, _prefetch_depth))
+        while pending:
+            (s, res) = pending.popleft()
+            for x in islice(it, 1):  # keep depth symbols in flight
+                pending.append((x, pool.apply_async(get_mkt_data, (x, from_date, to_date))))
+            yield (s, res.get())
+    finally:
+        pool.terminate()
+
+
+def date_range_index(mdata, from_date, to_date):
+    ''' Index range (lo, hi) of market data bars with from_date <= date <= to_date '''
+    dates = mdata['date']
+    return (int(np.searchsorted(dates, np.datetime64(from_date, 'D'))), int(np.searchsorted(dates, np.datetime64(to_date, 'D'), side='right')))
+
+
+def slice_mkt_data(mdata, lo, hi):
+    ''' Market data view of bars lo:hi, no data is copied '''
+    return dict((x, mdata[x][lo:hi]) for x in mdata.keys())
+
+
+@lru_cache(maxsize=32)
+def _load_mkt_data(symbol, from_date, to_date):
+    _lru.miss = True
+    if _cache_dir is None or _source_cache_id() is None:
+        return _to_talib_format(_get_marketdata(symbol, from_date, to_date))
+    path = _cache_path(symbol, from_date, to_date)
+    if not os.path.exists(path):
+        mdata = _to_talib_format(_get_marketdata(symbol, from_date, to_date))
+        if mdata is None:
+            return None
+        _save_cached(path, mdata)
+    return _load_cached(path)
 
 
 def approx_equal(a, b, tol):
@@ -72,6 +369,7 @@ def percent_equal(a, b, comp, tol):
     return (abs(a - b) / comp) * 100 < tol
 
 
+@profiling.timed('filter')
 def has_split_dividents(mdata, from_date, to_date):
     ''' Verifies if market data interval has splits, dividends '''
     from_diff = abs(mdata['close'][from_date] - mdata['adj_close'][from_date])
@@ -81,7 +379,50 @@ def has_split_dividents(mdata, from_date, to_date):
     return not percent_equal(from_diff, to_diff, mdata['close'][to_date], 0.8)
 
 
+@profiling.timed('filter')
 def odd_data(open_position, close_position):
     if approx_equal(0, open_position, 0.1) or approx_equal(0, close_position, 0.1):
         return True
     return abs(open_position - close_position) > min(open_position, close_position)
+
+
+@profiling.timed('filter')
+def split_dividents_mask(mdata, from_idx, to_idx):
+    ''' Vectorized has_split_dividents for arrays of interval boundaries '''
+    close = np.asarray(mdata['close'])
+    adj_close = np.asarray(mdata['adj_close'])
+    from_diff = np.abs(close[from_idx] - adj_close[from_idx])
+    to_diff = np.abs(close[to_idx] - adj_close[to_idx])
+    diff = np.abs(from_diff - to_diff)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ~(diff < 0.0001) & ~((diff / close[to_idx]) * 100 < 0.8)
+
+
+@profiling.timed('filter')
+def odd_data_mask(open_position, close_position):
+    ''' Vectorized odd_data for arrays of positions '''
+    min_position = np.where(close_position < open_position, close_position, open_position)
+    return (np.abs(open_position) < 0.1) | (np.abs(close_position) < 0.1) | (np.abs(open_position - close_position) > min_position)
+
+
+def rolling_mean_std(values, days):
+    ''' Mean and standard deviation of the last days values at every position, NaN before the first days values '''
+    values = np.asarray(values, dtype=np.float64)
+    mean = np.full(len(values), np.nan)
+    std = np.full(len(values), np.nan)
+    if len(values) >= days:
+        s1 = np.cumsum(np.r_[0.0, values])
+        s2 = np.cumsum(np.r_[0.0, values * values])
+        mean[days - 1:] = (s1[days:] - s1[:-days]) / days
+        std[days - 1:] = np.sqrt(np.maximum((s2[days:] - s2[:-days]) / days - mean[days - 1:] ** 2, 0))
+    return (mean, std)
+
+
+def window_matrix(values, start, stop, width):
+    '''
+    Gathers values[start[i]:stop[i]] windows into (len(start) x width) matrix.
+    Windows shorter than width are padded with their last value, so min/max over rows are not affected.
+    Windows must not be empty.
+    '''
+    cols = np.minimum(start[:, None] + np.arange(width), (stop - 1)[:, None])
+    return np.asarray(values)[cols]
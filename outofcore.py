@@ -0,0 +1,102 @@
+# coding:utf-8
+'''
+Out-of-core helpers: symbols are processed in chunks, results growing with number of symbols
+are spilled to disk after every chunk and merged at the end.
+'''
+import os
+import sys
+import struct
+import zipfile
+import resource
+import numpy as np
+
+
+def peak_rss():
+    ''' Peak resident memory of this process or any of its finished workers in bytes '''
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss if sys.platform == 'darwin' else rss * 1024  # kilobytes on linux
+
+
+def current_rss():
+    ''' Resident memory of this process in bytes, peak_rss where /proc is not available '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return peak_rss()
+
+
+def symbol_chunks(symbols, chunk_size, memory_limit=None):
+    '''
+    Yields consecutive chunks of symbols in symbols order.
+    memory_limit - bytes, chunk size is halved whenever resident memory after a chunk exceeds it
+    '''
+    pos = 0
+    while pos < len(symbols):
+        yield symbols[pos:pos + chunk_size]
+        pos += chunk_size
+        if memory_limit and current_rss() > memory_limit:
+            chunk_size = max(chunk_size / 2, 1)
+
+
+def spill_columns(path, chunk, columns):
+    ''' Saves columns of one chunk to path as separate .npy files, see save_spilled_npz '''
+    for (k, x) in columns.items():
+        np.save(os.path.join(path, '%s.%d.npy' % (k, chunk)), x)
+
+
+def merge_spilled(path, chunks, name):
+    '''
+    Column of chunks concatenated in memory mapped name.npy file in path, memory holds no whole column.
+    Column is merged once, later calls map the same file.
+    '''
+    fname = os.path.join(path, '%s.npy' % name)
+    if not os.path.exists(fname):
+        parts = [np.load(os.path.join(path, '%s.%d.npy' % (name, i)), mmap_mode='r') for i in range(chunks)]
+        out = np.lib.format.open_memmap(fname + '.tmp', mode='w+', dtype=parts[0].dtype, shape=(sum(len(x) for x in parts),) + parts[0].shape[1:])
+        pos = 0
+        for x in parts:
+            out[pos:pos + len(x)] = x
+            pos += len(x)
+        del out  # flushed
+        os.rename(fname + '.tmp', fname)
+    return np.load(fname, mmap_mode='r')
+
+
+def save_spilled_npz(fname, path, chunks, names, columns):
+    '''
+    Writes the same file as np.savez(fname, **columns) with spilled columns of chunks concatenated (see merge_spilled).
+    names - spilled columns, columns - other (not spilled) columns
+    '''
+    with zipfile.ZipFile(fname, 'w', zipfile.ZIP_STORED, allowZip64=True) as z:
+        for (k, x) in columns.items():
+            tmp = os.path.join(path, '%s.npy' % k)
+            np.save(tmp, x)
+            z.write(tmp, k + '.npy')
+        for k in names:
+            merge_spilled(path, chunks, k)
+            z.write(os.path.join(path, '%s.npy' % k), k + '.npy')
+
+
+def load_npz(fname):
+    '''
+    Columns of .npz file like np.load(fname), uncompressed (np.savez, save_spilled_npz) columns
+    are memory mapped in place instead of being read to memory.
+    '''
+    res = {}
+    with zipfile.ZipFile(fname) as z, open(fname, 'rb') as f:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                res[name] = np.lib.format.read_array(z.open(info))
+                continue
+            f.seek(info.header_offset + 26)  # name and extra field lengths of local file header
+            (name_len, extra_len) = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            (shape, fortran, dtype) = (np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0)(f)
+            if dtype.hasobject or not shape or 0 in shape:  # np.memmap can't map these
+                res[name] = np.lib.format.read_array(z.open(info))
+            else:
+                res[name] = np.memmap(fname, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran else 'C')
+    return res
@@ -0,0 +1,150 @@
+# coding:utf-8
+'''
+Opt-in timing of hot path stages.
+Stages are recorded per process (per Pool worker) and optionally per pattern, Job returns worker stats to parent process.
+'''
+import os
+import json
+import time
+import threading
+from functools import wraps
+from multiprocessing import current_process
+
+
+_enabled = False
+_stats = {}  # worker -> {'stages': {stage: [calls, seconds]}, 'patterns': {pattern: {stage: [calls, seconds]}}, 'counters': {name: n}}
+_lock = threading.Lock()  # stats are updated by threads too, e.g. prefetch_mkt_data loaders
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def enabled():
+    return _enabled
+
+
+def _new_stats():
+    return {'stages': {}, 'patterns': {}, 'counters': {}}
+
+
+def _worker_stats():
+    return _stats.setdefault(current_process().name, _new_stats())
+
+
+def _add(d, key, seconds, calls=1):
+    x = d.setdefault(key, [0, 0.0])
+    x[0] += calls
+    x[1] += seconds
+
+
+def _merge_worker(dst, w):
+    for (k, (calls, seconds)) in w['stages'].items():
+        _add(dst['stages'], k, seconds, calls)
+    for (p, stages) in w['patterns'].items():
+        for (k, (calls, seconds)) in stages.items():
+            _add(dst['patterns'].setdefault(p, {}), k, seconds, calls)
+    for (k, n) in w['counters'].items():
+        dst['counters'][k] = dst['counters'].get(k, 0) + n
+
+
+def add(stage, seconds, pattern=None):
+    ''' Records stage call which took seconds '''
+    with _lock:
+        w = _worker_stats()
+        _add(w['stages'], stage, seconds)
+        if pattern is not None:
+            _add(w['patterns'].setdefault(pattern, {}), stage, seconds)
+
+
+def count(name, n=1):
+    with _lock:
+        counters = _worker_stats()['counters']
+        counters[name] = counters.get(name, 0) + n
+
+
+def timed(stage, pattern=None):
+    '''
+    Decorator recording function timing as stage when profiling is enabled
+    pattern - optional function returning pattern name from call arguments
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(stage, time.time() - start, pattern(*args, **kwargs) if pattern else None)
+        return wrapper
+    return decorator
+
+
+def take_stats():
+    ''' Returns stats collected so far and resets them '''
+    global _stats
+    with _lock:
+        (res, _stats) = (_stats, {})
+    return res
+
+
+def merge(stats):
+    ''' Merges stats returned by take_stats of other process '''
+    with _lock:
+        for (name, w) in stats.items():
+            _merge_worker(_stats.setdefault(name, _new_stats()), w)
+
+
+class Job(object):
+    ''' Wraps Pool job function, job returns (result, stats collected by worker while running the job) '''
+    def __init__(self, func):
+        self._func = func
+
+    def __call__(self, args):
+        res = self._func(args)
+        if not _enabled:
+            return (res, {})
+        name = current_process().name  # only own stats, worker also inherits stats of parent process
+        with _lock:
+            return (res, {name: _stats.pop(name, _new_stats())})
+
+
+def summary():
+    ''' Stats of all workers added together '''
+    total = _new_stats()
+    with _lock:
+        for w in _stats.values():
+            _merge_worker(total, w)
+    return total
+
+
+def _stage_rows(stages):
+    return [(k, calls, seconds) for (k, (calls, seconds)) in sorted(stages.items(), key=lambda x: -x[1][1])]
+
+
+def write_report(outpath):
+    ''' Writes timing.json and timing.html to results directory '''
+    from helpers import create_table
+    total = summary()
+    counters = total['counters']
+    lookups = counters.get('lru_hit', 0) + counters.get('lru_miss', 0)
+    lru_hit_rate = float(counters.get('lru_hit', 0)) / lookups if lookups else 0.0
+
+    with open(os.path.join(outpath, 'timing.json'), 'w') as f:
+        json.dump({'total': total, 'workers': _stats, 'lru_hit_rate': lru_hit_rate}, f, indent=1, sort_keys=True)
+
+    with open(os.path.join(outpath, 'timing.html'), 'w') as f:
+        f.write('<h3>Stages</h3>')
+        create_table(f, ['Stage', 'Calls', 'Seconds'], _stage_rows(total['stages']), ['%s', '%d', '%.3f'])
+        f.write('<h3>Marketdata cache</h3>')
+        f.write('<b>get_mkt_data LRU hit rate: %.1f%% of %d lookups</b><br/>' % (lru_hit_rate * 100, lookups))
+        create_table(f, ['Counter', 'Value'], sorted(counters.items()), ['%s', '%d'])
+        f.write('<h3>Workers</h3>')
+        rows = [(name, k, calls, seconds) for (name, w) in sorted(_stats.items()) for (k, calls, seconds) in _stage_rows(w['stages'])]
+        create_table(f, ['Worker', 'Stage', 'Calls', 'Seconds'], rows, ['%s', '%s', '%d', '%.3f'])
+        f.write('<h3>Patterns</h3>')
+        rows = [(p, k, calls, seconds) for (p, stages) in sorted(total['patterns'].items()) for (k, calls, seconds) in _stage_rows(stages)]
+        create_table(f, ['Pattern', 'Stage', 'Calls', 'Seconds'], rows, ['%s', '%s', '%d', '%.3f'])
@@ -0,0 +1,35 @@
+# coding:utf-8
+'''
+Candlestick charts rendering, matplotlib is imported only by this module
+'''
+import matplotlib
+matplotlib.use('Agg')  # charts are only saved to files
+import pylab as pl
+from matplotlib.dates import DateFormatter, WeekdayLocator, DayLocator, MONDAY
+from matplotlib.finance import candlestick
+import profiling
+
+
+@profiling.timed('charts')
+def save_candlestick_chart(fname, quotes):
+    '''
+    quotes should have the following format: [(date1, open1, close1, high1, low1), (date2, open2, ...), (...), ...]
+    '''
+    mondays = WeekdayLocator(MONDAY)
+    alldays = DayLocator()
+    weekFormatter = DateFormatter('%b %d')
+
+    fig = pl.figure()
+    fig.subplots_adjust(bottom=0.2)
+    ax = fig.add_subplot(111)
+    ax.xaxis.set_major_locator(mondays)
+    ax.xaxis.set_minor_locator(alldays)
+    ax.xaxis.set_major_formatter(weekFormatter)
+
+    candlestick(ax, quotes, width=0.6, colorup='g')
+    ax.xaxis_date()
+    ax.autoscale_view()
+    pl.setp(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
+
+    fig.savefig(fname)
+    pl.close(fig)  # release figure memory
@@ -0,0 +1,60 @@
+# coding:utf-8
+'''
+Content addressed cache of per symbol partial results.
+Entries are keyed by hash of symbol market data and run parameters, so changed data or parameters
+simply miss the cache and nothing has to be invalidated.
+'''
+import os
+import hashlib
+import cPickle as pickle
+from helpers import atomic_write
+import profiling
+
+
+RESULT_CACHE_DIR = '.resultcache'
+
+_cache_dir = None  # None disables result caching, see set_result_cache_dir
+
+
+def set_result_cache_dir(path):
+    ''' Sets result cache directory, None disables result caching '''
+    global _cache_dir
+    _cache_dir = path
+
+
+def enabled():
+    return _cache_dir is not None
+
+
+def data_hash(mdata):
+    ''' Hash of market data content (all fields) '''
+    h = hashlib.sha1()
+    for x in sorted(mdata.keys()):
+        h.update(x)
+        h.update(mdata[x].tostring())
+    return h.hexdigest()
+
+
+def make_key(*parts):
+    ''' Cache key of parts, parts should have stable repr (strings, numbers, dates, tuples of them) '''
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def _path(kind, key):
+    return os.path.join(_cache_dir, kind, key[:2], key + '.pkl')
+
+
+def load(kind, key):
+    ''' Returns cached value or None '''
+    try:
+        with open(_path(kind, key), 'rb') as f:
+            res = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        res = None
+    if profiling.enabled():
+        profiling.count('result_hit' if res is not None else 'result_miss')
+    return res
+
+
+def save(kind, key, value):
+    atomic_write(_path(kind, key), lambda f: pickle.dump(value, f, pickle.HIGHEST_PROTOCOL))
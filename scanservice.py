@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# coding:utf-8
+'''
+Long-running scan service: market data and pattern events of a universe are loaded once and kept in memory,
+events and backtest requests are answered over a local (unix) socket.
+Protocol is one JSON object per line in both directions, e.g.
+{"cmd": "events", "pattern": "CDLHAMMER"} or {"cmd": "backtest", "strategies": [["CDLHAMMER", 100, 5, 1, 0.01]]}
+'''
+import os
+import json
+import logging
+import socket
+import argparse
+import SocketServer
+import numpy as np
+from datetime import datetime
+from collections import OrderedDict
+from helpers import talib_candlestick_funcs, load_symbols, mkdate
+from mktdata import MktTypes, init_marketdata, refresh_marketdata, load_bars, SharedMktData, use_shared_mkt_data
+from incremental import IncrementalPatternDetector
+from events import CandlestickPatternEvents
+from backtesting import StrategySweep, load_strategies, group_strategies
+
+
+SOCKET_PATH = '.scanservice.sock'
+
+
+def _today():
+    return datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class ScanService(object):
+    '''
+    Keeps market data of all symbols in one SharedMktData block and events of all patterns
+    in the {pattern: {symbol: (indexes, values)}} index used by StrategyRunner/StrategySweep,
+    reload appends new bars to both.
+    Answers are memoized until the next reload.
+    '''
+    def __init__(self, symbols, candlestick_funcitons, from_date, to_date):
+        self.symbols = list(symbols)
+        self.from_date = from_date
+        self.to_date = to_date
+        self._palg = candlestick_funcitons
+        self._detector = IncrementalPatternDetector(candlestick_funcitons)
+        self._events = dict((a, {}) for a in candlestick_funcitons)
+        self._last = {}  # symbol -> date of the last bar loaded
+        self._shared = SharedMktData(self.symbols, from_date, to_date)
+        for s in self.symbols:
+            if s in self._shared:
+                self._add_bars(self._detector, self._events, self._last, s, self._shared.get(s))
+        use_shared_mkt_data(self._shared)
+        self._memo = {}
+
+    @staticmethod
+    def _add_bars(detector, events, last, symbol, bars):
+        ''' Detects patterns in bars appended to symbol history '''
+        for (a, (idxs, vals)) in detector.update(symbol, bars).items():
+            if symbol in events[a]:
+                (idxs, vals) = [np.concatenate(x) for x in zip(events[a][symbol], (idxs, vals))]
+            events[a][symbol] = (idxs, vals)
+        last[symbol] = bars['date'][-1]
+
+    def _next_day(self, symbol):
+        if symbol not in self._last:
+            return self.from_date
+        x = (self._last[symbol] + 1).astype(datetime)
+        return datetime(x.year, x.month, x.day)
+
+    def reload(self, to_date=None, fetch=True):
+        '''
+        Appends bars after the last loaded one up to to_date (today by default), fetching them to marketdata db first if fetch is set.
+        Only new bars are read (bypassing marketdata caches) and patterns are detected in new bars only.
+        Loaded bars are kept as they are, revised history needs service restart.
+        New state is swapped in at the end, so failed reload keeps serving the previous one.
+        '''
+        to_date = to_date or _today()
+        if fetch:
+            refresh_marketdata(min(self._next_day(s) for s in self.symbols), to_date)
+        bars = OrderedDict()
+        for s in self.symbols:
+            x = load_bars(s, self._next_day(s), to_date)
+            if x:
+                bars[s] = x
+        (detector, events, last) = (self._detector.copy(), dict((a, dict(x)) for (a, x) in self._events.items()), dict(self._last))
+        for (s, x) in bars.items():
+            self._add_bars(detector, events, last, s, x)
+        shared = self._shared.extended(bars, to_date)
+        (self._detector, self._events, self._last, self._shared, self.to_date) = (detector, events, last, shared, to_date)
+        use_shared_mkt_data(shared)
+        self._memo.clear()
+        return {'to': to_date.strftime('%Y-%m-%d'), 'new_bars': sum(len(x['date']) for x in bars.values())}
+
+    def _pattern(self, pattern):
+        pattern = str(pattern)
+        if pattern not in self._events:
+            raise ValueError('Unknown pattern: %s' % pattern)
+        return pattern
+
+    def events(self, pattern, value=None, details=False):
+        '''
+        Average changes of pattern events as in events.py, details adds [symbol, date, value] of every event
+        '''
+        pattern = self._pattern(pattern)
+        key = ('events', pattern, value, details)
+        if key not in self._memo:
+            c = CandlestickPatternEvents(self.symbols, [pattern], self.from_date, self.to_date)
+            res = []
+            for s in self.symbols:
+                if s not in self._events[pattern]:
+                    continue
+                (idxs, vals) = self._events[pattern][s]
+                sel = vals == value if value is not None else slice(None)
+                avgs = OrderedDict()
+                c._process_patterns((idxs[sel], vals[sel]), self._shared.get(s), pattern, avgs)
+                c._merge(avgs)
+                if details:
+                    dates = self._shared.get(s)['date'][idxs[sel]]
+                    res.extend([s, str(d), int(v)] for (d, v) in zip(dates, vals[sel]))
+            stats = [dict([('key', k), ('events', val.cnt())] + [(m, [float(x) for x in val.average(m)]) for m in MktTypes]) for (k, val) in c.average_changes]
+            self._memo[key] = {'stats': stats, 'events': res} if details else {'stats': stats}
+        return self._memo[key]
+
+    def backtest(self, strategies, exit_policy='fixed'):
+        '''
+        strategies - strategies params as in strategies file
+        Returns [strategy params..., profit, number of transactions] of every strategy
+        '''
+        strategies = tuple((self._pattern(x[0]), int(x[1]), int(x[2]), int(x[3]), float(x[4])) for x in strategies)
+        key = ('backtest', strategies, exit_policy)
+        if key not in self._memo:
+            res = [None] * len(strategies)
+            for group in group_strategies(strategies):
+                sw = StrategySweep([x for (_, x) in group], exit_policy=exit_policy)(self.symbols, self.from_date, self.to_date, self._events[group[0][1][0]])
+                for ((i, _), r) in zip(group, sw.runners):
+                    res[i] = list(r.params()) + [r.balance, len(r.txns)]
+            self._memo[key] = {'results': res}
+        return self._memo[key]
+
+    def status(self):
+        return {'symbols': len(self._last), 'patterns': len(self._palg), 'from': self.from_date.strftime('%Y-%m-%d'), 'to': self.to_date.strftime('%Y-%m-%d')}
+
+    def handle(self, request):
+        ''' Dispatches request dictionary, errors are returned as {"error": message} '''
+        try:
+            cmd = request.get('cmd')
+            if cmd == 'events':
+                return self.events(request['pattern'], request.get('value'), request.get('details', False))
+            if cmd == 'backtest':
+                return self.backtest(request['strategies'], str(request.get('exit', 'fixed')))
+            if cmd == 'reload':
+                return self.reload(mkdate(request['to']) if request.get('to') else None, request.get('fetch', True))
+            if cmd == 'status':
+                return self.status()
+            raise ValueError('Unknown command: %s' % cmd)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+        except Exception as e:  # e.g. marketdata db error, server keeps running
+            logging.exception('Request %s failed', request.get('cmd'))
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+
+
+class _ScanHandler(SocketServer.StreamRequestHandler):
+    ''' Serves requests of one connection until client closes it or sends stop '''
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('request should be an object')
+            except ValueError as e:
+                request = {}
+                response = {'error': 'Bad request: %s' % e}
+            else:
+                response = {'stopped': True} if request.get('cmd') == 'stop' else self.server.service.handle(request)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+            if request.get('cmd') == 'stop':
+                self.server.running = False
+                return
+
+
+class ScanServer(SocketServer.UnixStreamServer):
+    '''
+    Serves one connection at a time, so requests never run concurrently.
+    reload_every - seconds without connections after which new bars are loaded (see ScanService.reload)
+    '''
+    def __init__(self, service, path=SOCKET_PATH, reload_every=None):
+        if os.path.exists(path):
+            os.unlink(path)  # left by a killed server
+        SocketServer.UnixStreamServer.__init__(self, path, _ScanHandler)
+        self.service = service
+        self.timeout = reload_every
+        self.running = True
+
+    def handle_timeout(self):
+        try:
+            self.service.reload()
+        except Exception:
+            logging.exception('Reload failed, serving bars up to %s', self.service.to_date.strftime('%Y-%m-%d'))
+
+    def serve(self):
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.unlink(self.server_address)
+
+
+class ScanClient(object):
+    ''' Keeps connection to ScanServer, so a request costs one round trip '''
+    def __init__(self, path=SOCKET_PATH):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rwb')
+
+    def request(self, cmd, **params):
+        ''' Returns response dictionary, raises RuntimeError on error response '''
+        params['cmd'] = cmd
+        self._file.write(json.dumps(params) + '\n')
+        self._file.flush()
+        res = json.loads(self._file.readline())
+        if 'error' in res:
+            raise RuntimeError(res['error'])
+        return res
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def serve_main(fname, from_date, to_date, path, reload_every=None):
+    symbols = load_symbols(fname)
+    to_date = to_date or _today()
+    init_marketdata(symbols, from_date, to_date)
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    service = ScanService(symbols, talib_candlestick_funcs(), from_date, to_date)
+    print('Serving %d symbols on %s' % (len(symbols), path))
+    ScanServer(service, path, reload_every).serve()
+
+
+def client_main(args):
+    client = ScanClient(args.socket)
+    try:
+        if args.cmd == 'events':
+            res = client.request('events', pattern=args.pattern, value=args.value, details=args.details)
+        elif args.cmd == 'backtest':
+            res = client.request('backtest', strategies=load_strategies(args.strategies), exit=args.exit)
+        elif args.cmd == 'reload':
+            res = client.request('reload', to=args.todate, fetch=not args.no_fetch)
+        else:
+            res = client.request(args.cmd)
+    finally:
+        client.close()
+    print(json.dumps(res, indent=1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Candlestick scan service')
+    parser.add_argument('--socket', metavar='PATH', type=str, default=SOCKET_PATH, help='service socket')
+    commands = parser.add_subparsers(dest='cmd')
+    p = commands.add_parser('serve', help='load symbols and serve requests')
+    p.add_argument('-f', '--fromdate', metavar='YYYYMMDD', type=mkdate, required=True, help='from date in format YYYYMMDD')
+    p.add_argument('-t', '--todate', metavar='YYYYMMDD', type=mkdate, help='to date in format YYYYMMDD, today by default')
+    p.add_argument('-s', '--shares', metavar='FILENAME', type=str, required=True, help='file with list of shares')
+    p.add_argument('--reload-every', metavar='SECONDS', type=float, help='load new bars when idle for SECONDS')
+    p = commands.add_parser('events', help='average changes of pattern events')
+    p.add_argument('pattern', metavar='PATTERN', type=str)
+    p.add_argument('--value', metavar='N', type=int, help='pattern value, all values by default')
+    p.add_argument('--details', action='store_true', help='list every event')
+    p = commands.add_parser('backtest', help='run strategies over in-memory events')
+    p.add_argument('strategies', metavar='STRATEGIES_FILE', type=str)
+    p.add_argument('--exit', metavar='POLICY', type=str, default='fixed', help='exit policy, see backtesting.py')
+    p = commands.add_parser('reload', help='load new bars')
+    p.add_argument('-t', '--todate', metavar='YYYYMMDD', type=str, help='to date in format YYYYMMDD, today by default')
+    p.add_argument('--no-fetch', action='store_true', help='do not fetch bars to marketdata db, it is updated by other means')
+    commands.add_parser('status', help='loaded symbols and date range')
+    commands.add_parser('stop', help='stop service')
+
+    args = parser.parse_args()
+    if args.cmd == 'serve':
+        serve_main(args.shares, args.fromdate, args.todate, args.socket, args.reload_every)
+    else:
+        client_main(args)
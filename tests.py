@@ -1,14 +1,50 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import subprocess
+import threading
 import unittest
 from test import test_support
 import numpy as np
 from datetime import datetime
-from events import AverageChange, CandlestickPatternEvents
-from mktdata import init_marketdata, has_split_dividents, odd_data
-from helpers import talib_candlestick_funcs, find_candlestick_patterns
-from backtesting import StrategyRunner
+from events import AverageChange, CandlestickPatternEvents, EventTable, pattern_significance, output_results as output_events
+import mktdata
+from mktdata import init_marketdata, get_mkt_data, prefetch_mkt_data, FileMarketdata, SharedMktData, use_shared_mkt_data, has_split_dividents, odd_data, split_dividents_mask, odd_data_mask, _to_talib_format, _save_cached, _load_cached
+from helpers import talib_candlestick_funcs, talib_call, find_candlestick_patterns, stack_ohlc, find_pattern_event_matrix, matrix_pattern_events
+from incremental import IncrementalPatternDetector
+from walkforward import WalkForward, walk_forward_windows
+from scanservice import ScanService, ScanServer, ScanClient
+import profiling
+import resultcache
+from txnlog import create_log, TxnLogWriter, TxnLog
+import backtesting
+from backtesting import StrategyRunner, StrategySweep, parse_exit_policy, pattern_event_index, symbol_batches, sweep_grid, group_strategies, pattern_runner, chunked_runner, output_results
+from outofcore import symbol_chunks, load_npz
+
+
+def synthetic_mdata(n, seed=0):
+    ''' Random walk market data with a split in the middle and a few zero prices '''
+    rs = np.random.RandomState(seed)
+    close = 100.0 * np.exp(np.cumsum(rs.normal(0, 0.02, n)))
+    open = close * (1 + rs.normal(0, 0.01, n))
+    open[rs.randint(0, n, 3)] = 0.0
+    adj_close = close.copy()
+    adj_close[:n / 2] /= 2
+    return {'date': np.arange(n).astype('datetime64[D]'), 'open': open, 'close': close, 'adj_close': adj_close,
+            'high': np.maximum(open, close) * (1 + rs.uniform(0, 0.03, n)), 'low': np.minimum(open, close) * (1 - rs.uniform(0, 0.03, n))}
+
+
+def talib_events(cfunc, mdata):
+    ''' Reference (indexes, values) of non zero results of one talib call '''
+    res = talib_call(cfunc, mdata['open'], mdata['high'], mdata['low'], mdata['close'])
+    idx = np.flatnonzero(res)
+    return (idx, res[idx])
 
 
 class TestAverageChange(unittest.TestCase):
@@ -50,6 +86,46 @@ class TestAverageChange(unittest.TestCase):
         self.assertAlmostEquals(2, o.average('open')[1])
         self.assertAlmostEquals(5, o.average('open')[2])
 
+    def test_add_batch(self):
+        o = AverageChange(3)
+        o.add_batch('open', [2, 2, 2], [[1, 4, 10], [2, 4, 0], [3, 0, 0]], [3, 2, 1])
+
+        self.assertEquals(3, o.cnt())
+        self.assertEquals(3, len(o.average('open')))
+        self.assertAlmostEquals(1, o.average('open')[0])
+        self.assertAlmostEquals(2, o.average('open')[1])
+        self.assertAlmostEquals(5, o.average('open')[2])
+        self.assertEquals([], o.average('close'))
+
+    def test_merge(self):
+        o = AverageChange(2)
+        o.add('open', 1, [1, 2])
+        p = AverageChange(2)
+        p.add('open', 1, [3])
+        o.merge(p)
+        self.assertEquals(2, o.cnt())
+        self.assertEquals([2.0, 2.0], o.average('open'))
+
+    def test_repr(self):
+        o = AverageChange(2)
+        o.add('open', 2, [1, 3])
+        self.assertEquals('<AverageChange. Number of events: 1\nopen: [0.5, 1.5]\nhigh: []\nlow: []\nclose: []>', repr(o))
+
+
+class TestSignificance(unittest.TestCase):
+    def test_pattern_significance(self):
+        rs = np.random.RandomState(0)
+        pools = [(rs.normal(0, 0.02, 500), 40), (rs.normal(0.001, 0.03, 300), 60)]
+        noise = np.concatenate([pool[rs.randint(0, len(pool), cnt)] for (pool, cnt) in pools])
+        res = pattern_significance(('CDLX:100', noise, pools, 2000, 0))
+        self.assertEquals(res, pattern_significance(('CDLX:100', noise, pools, 2000, 0)))  # reproducible
+        self.assertEquals(100, res[1])
+        self.assertTrue(res[4] > 0.05)
+        self.assertTrue(res[5] < res[2] < res[6])
+        res = pattern_significance(('CDLX:100', noise + 0.01, pools, 2000, 0))
+        self.assertTrue(res[4] < 0.01)
+        self.assertTrue(res[5] > res[3])  # confidence interval is above random entry mean
+
 
 class TestFindCandlestickPatterns(unittest.TestCase):
     def test_CDL3OUTSIDE_res(self):
@@ -62,6 +138,36 @@ class TestFindCandlestickPatterns(unittest.TestCase):
         res = find_candlestick_patterns('CDL3OUTSIDE', mdata)
         self.assertEquals([(3, 100)], list(res))
 
+    def test_event_matrix(self):
+        mdatas = [synthetic_mdata(300, 1), None, synthetic_mdata(120, 2)]
+        palg = talib_candlestick_funcs()
+        (block, lengths) = stack_ohlc(mdatas)
+        self.assertEquals([300, 0, 120], lengths.tolist())
+        self.assertTrue(np.isnan(block['close'][2, 120:]).all())
+        matrix = find_pattern_event_matrix(block, lengths, palg, threads=2)
+        self.assertEquals(sorted(matrix.tolist()), matrix.tolist())
+        for i in [0, 2]:
+            for (p, a) in enumerate(palg):
+                (idx, vals) = matrix_pattern_events(matrix, i, p)
+                (expected_idx, expected_vals) = talib_events(a, mdatas[i])
+                self.assertEquals(expected_idx.tolist(), idx.tolist())
+                self.assertEquals(expected_vals.tolist(), vals.tolist())
+
+
+class TestIncrementalPatternDetector(unittest.TestCase):
+    def test_matches_full_history(self):
+        mdata = synthetic_mdata(400)
+        palg = talib_candlestick_funcs()
+        d = IncrementalPatternDetector(palg)
+        found = dict((a, []) for a in palg)
+        for (start, stop) in [(0, 300)] + [(i, i + 1) for i in range(300, 390)] + [(390, 400)]:
+            res = d.update('X', dict((x, mdata[x][start:stop]) for x in mdata.keys()))
+            for a in palg:
+                found[a].extend(zip(*res[a]))
+        self.assertEquals(400, d.bars('X'))
+        for a in palg:
+            self.assertEquals(zip(*talib_events(a, mdata)), found[a])
+
 
 class EventsRegressionTest(unittest.TestCase):
     def test_CandlestickPatternEvents(self):
@@ -79,6 +185,75 @@ class EventsRegressionTest(unittest.TestCase):
         self.assertEquals(3, changes[16][1].cnt())
         self.assertAlmostEquals(1.02994350282, changes[16][1].average('open')[-1])
 
+    def test_parallel_CandlestickPatternEvents(self):
+        from_date = datetime(2012, 1, 1)
+        to_date = datetime(2012, 1, 31)
+        symbols = ['ABF.L', 'ADM.L', 'BRBY.L']
+        init_marketdata(symbols, from_date, to_date)
+
+        palg = talib_candlestick_funcs()
+
+        serial = list(CandlestickPatternEvents(symbols, palg, from_date, to_date)().average_changes)
+        parallel = list(CandlestickPatternEvents(symbols, palg, from_date, to_date, workers=2)().average_changes)
+        self.assertEquals([k for (k, _) in serial], [k for (k, _) in parallel])
+        for ((_, a), (_, b)) in zip(serial, parallel):
+            self.assertEquals(a.cnt(), b.cnt())
+            self.assertEquals(repr(a), repr(b))
+
+    def test_event_table(self):
+        from_date = datetime(2012, 1, 1)
+        to_date = datetime(2012, 1, 31)
+        symbols = ['ABF.L', 'ADM.L', 'BRBY.L']
+        init_marketdata(symbols, from_date, to_date)
+
+        palg = talib_candlestick_funcs()
+
+        c = CandlestickPatternEvents(symbols, palg, from_date, to_date, details=True)()
+        path = tempfile.mkdtemp()
+        try:
+            c.save_event_table(os.path.join(path, 'events.npz'))
+            t = EventTable(os.path.join(path, 'events.npz'))
+        finally:
+            shutil.rmtree(path)
+        changes = sorted(c.average_changes)
+        self.assertEquals([(k, repr(v)) for (k, v) in changes], [(k, repr(v)) for (k, v) in sorted(t.average_changes())])
+        self.assertEquals(sum(v.cnt() for (_, v) in changes), len(t.date))
+        (key, avg) = changes[0]
+        rows = t.rows(key.split(':')[0])
+        self.assertTrue((t.pattern[rows] == palg.index(key.split(':')[0])).all())
+        self.assertEquals(avg.average('close')[:3], dict(t.average_changes(rows, days=3))[key].average('close'))
+
+
+class WalkForwardRegressionTest(unittest.TestCase):
+    def test_windows(self):
+        windows = walk_forward_windows(datetime(2010, 1, 31), datetime(2012, 12, 31), 12, 6)
+        self.assertEquals(3, len(windows))
+        self.assertEquals((datetime(2010, 1, 31), datetime(2011, 1, 30), datetime(2011, 1, 31), datetime(2011, 7, 30)), windows[0])
+        self.assertEquals(datetime(2010, 7, 31), windows[1][0])
+        self.assertEquals(datetime(2011, 1, 31), windows[2][0])
+        self.assertEquals(datetime(2012, 7, 30), windows[-1][3])
+
+    def test_first_window_matches_single_run(self):
+        from_date = datetime(2011, 1, 1)
+        to_date = datetime(2012, 12, 31)
+        symbols = ['AZN.L', 'FRES.L', 'IAG.L']
+        init_marketdata(symbols, from_date, to_date)
+
+        palg = talib_candlestick_funcs()
+        strategies = sweep_grid('CDL3WHITESOLDIERS', 100, [3, 5], [0, 1], [0.02])
+        windows = walk_forward_windows(from_date, to_date, 12, 6)
+        serial = WalkForward(symbols, palg, strategies, from_date, to_date, windows)()
+        parallel = WalkForward(symbols, palg, strategies, from_date, to_date, windows, workers=2)()
+        self.assertEquals(serial.strategy_rows(), parallel.strategy_rows())
+        self.assertEquals(serial.event_rows(0.0, 1), parallel.event_rows(0.0, 1))
+
+        # in-sample period of the first window starts with the data, so it is the same as a separate run
+        (_, train_to, _, _) = windows[0]
+        sw = StrategySweep(strategies)(symbols, from_date, train_to)
+        self.assertEquals([x[-1] for x in sw.results()], [x[-2] for x in serial.strategy_rows()[:len(strategies)]])
+        c = CandlestickPatternEvents(symbols, palg, from_date, train_to)()
+        self.assertEquals([(k, repr(v)) for (k, v) in c.average_changes], [(k, repr(v)) for (k, v) in serial._events[(0, 0)].average_changes])
+
 
 class TestMarketDataModule(unittest.TestCase):
     def test_has_split_dividents(self):
@@ -93,6 +268,95 @@ class TestMarketDataModule(unittest.TestCase):
         self.assertFalse(odd_data(100, 200))
         self.assertTrue(odd_data(100, 201))
 
+    def test_split_dividents_mask(self):
+        mdata = synthetic_mdata(200)
+        from_idx = np.arange(0, 190)
+        to_idx = from_idx + 9
+        expected = [has_split_dividents(mdata, f, t) for (f, t) in zip(from_idx, to_idx)]
+        self.assertEquals(expected, list(split_dividents_mask(mdata, from_idx, to_idx)))
+
+    def test_odd_data_mask(self):
+        self.assertEquals([False, False, True, True], list(odd_data_mask(np.array([100, 100, 100, 0.0]), np.array([100, 200, 201, 10.0]))))
+
+    def test_to_talib_format(self):
+        rows = [{'date': datetime(2012, 1, 2), 'adj_close': 1.5, 'open': 1.0, 'high': 2.0, 'low': 0.5, 'close': 1.5},
+                {'date': datetime(2012, 1, 3), 'adj_close': 2.5, 'open': 1.5, 'high': 3.0, 'low': 1.0, 'close': 2.5}]
+        res = _to_talib_format(rows)
+        self.assertEquals(np.float64, res['open'].dtype)
+        self.assertEquals([1.0, 1.5], list(res['open']))
+        self.assertEquals([2.5, 3.0], [res['close'][1], res['high'][1]])
+        self.assertEquals(np.datetime64('2012-01-03'), res['date'][1])
+        self.assertTrue(res['low'].flags['C_CONTIGUOUS'])
+        self.assertEquals(None, _to_talib_format([]))
+
+    def test_cache_roundtrip(self):
+        rows = [{'date': datetime(2012, 1, 2), 'adj_close': 1.5, 'open': 1.0, 'high': 2.0, 'low': 0.5, 'close': 1.5},
+                {'date': datetime(2012, 1, 3), 'adj_close': 2.5, 'open': 1.5, 'high': 3.0, 'low': 1.0, 'close': 2.5}]
+        mdata = _to_talib_format(rows)
+        path = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(path, 'X_20120101_20120131.npy')
+            _save_cached(fname, mdata)
+            res = _load_cached(fname)
+            for x in mdata.keys():
+                self.assertEquals(list(mdata[x]), list(res[x]))
+            self.assertFalse(res['open'].flags['WRITEABLE'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_cache_per_source(self):
+        path = tempfile.mkdtemp()
+        (first, second) = (FileMarketdata(os.path.join(path, 'first')), FileMarketdata(os.path.join(path, 'second')))
+        first.save('A', synthetic_mdata(50, 1))
+        second.save('A', synthetic_mdata(50, 2))
+        cache_dir = mktdata._cache_dir
+        mktdata.set_cache_dir(os.path.join(path, 'cache'))
+        (from_date, to_date) = (datetime(1970, 1, 1), datetime(1970, 12, 31))
+        try:
+            for (source, seed) in [(first, 1), (second, 2), (first, 1), (lambda *args: second(*args), 2)]:
+                mktdata.set_marketdata_source(source)
+                self.assertEquals(synthetic_mdata(50, seed)['close'].tolist(), get_mkt_data('A', from_date, to_date)['close'].tolist())
+            self.assertEquals(2, len(os.listdir(os.path.join(path, 'cache'))))  # sources without cache_id are not cached
+        finally:
+            mktdata.set_marketdata_source(None)
+            mktdata.set_cache_dir(cache_dir)
+            shutil.rmtree(path)
+
+    def test_prefetch_file_marketdata(self):
+        symbols = ['A', 'B', 'C', 'D', 'E']
+        path = tempfile.mkdtemp()
+        files = FileMarketdata(path)
+        for (i, s) in enumerate(symbols):
+            files.save(s, synthetic_mdata(50 + i, i))
+        requests = []
+
+        def source(symbol, from_date, to_date):
+            requests.append(symbol)
+            return files(symbol, from_date, to_date)
+
+        (cache_dir, depth) = (mktdata._cache_dir, mktdata._prefetch_depth)
+        mktdata.set_cache_dir(None)
+        mktdata.set_marketdata_source(source)
+        mktdata.set_prefetch(2)
+        try:
+            (from_date, to_date) = (datetime(1970, 1, 1), datetime(1970, 12, 31))
+            it = prefetch_mkt_data(symbols, from_date, to_date)
+            (s, mdata) = next(it)
+            self.assertEquals('A', s)
+            self.assertTrue(len(requests) <= 3)  # no more than depth symbols are loaded ahead
+            res = [(s, mdata)] + list(it)
+            self.assertEquals(symbols, [s for (s, _) in res])
+            for (i, (s, mdata)) in enumerate(res):
+                expected = synthetic_mdata(50 + i, i)
+                for x in expected.keys():
+                    self.assertEquals(expected[x].tolist(), mdata[x].tolist())
+                self.assertTrue(mdata is get_mkt_data(s, from_date, to_date))
+        finally:
+            mktdata.set_prefetch(depth)
+            mktdata.set_marketdata_source(None)
+            mktdata.set_cache_dir(cache_dir)
+            shutil.rmtree(path)
+
 
 class StrategyRunnerRegressionTest(unittest.TestCase):
     def test_long_strategy(self):
@@ -113,8 +377,137 @@ class StrategyRunnerRegressionTest(unittest.TestCase):
         sr = StrategyRunner('CDL3WHITESOLDIERS', 100, 3, 0, 0.02)(symbols, from_date, to_date)
         self.assertAlmostEqual(295.808, sr.balance, 2)
 
+    def test_shared_mkt_data(self):
+        from_date = datetime(2012, 1, 1)
+        to_date = datetime(2012, 1, 31)
+        symbols = ['BRBY.L', 'CNA.L', 'MGGT.L']
+        init_marketdata(symbols, from_date, to_date)
+
+        use_shared_mkt_data(SharedMktData(symbols, from_date, to_date))
+        try:
+            sr = StrategyRunner('CDL3LINESTRIKE', -100, 9, 1, 0.02)(symbols, from_date, to_date)
+        finally:
+            use_shared_mkt_data(None)
+        self.assertAlmostEqual(-353.443, sr.balance, 2)
+
+    def test_shared_pattern_events(self):
+        from_date = datetime(2012, 1, 1)
+        to_date = datetime(2012, 12, 31)
+        symbols = ['AZN.L', 'FRES.L', 'IAG.L']
+        init_marketdata(symbols, from_date, to_date)
+
+        events = pattern_event_index('CDL3WHITESOLDIERS', list(prefetch_mkt_data(symbols, from_date, to_date)))
+        sr = StrategyRunner('CDL3WHITESOLDIERS', 100, 3, 0, 0.02)(symbols, from_date, to_date, events)
+        self.assertAlmostEqual(295.808, sr.balance, 2)
+
 
 class TestStrategyRunner(unittest.TestCase):
+    def _process_scalar(self, sr, mdata, idxs):
+        for idx in idxs:
+            try:
+                sr._process_position('X', idx, mdata)
+            except:
+                pass
+        return sr
+
+    def test_process_positions_parity(self):
+        mdata = synthetic_mdata(300)
+        idxs = np.arange(0, 300, 2)
+        for hold_days in [0, 1, 2, 3, 9]:
+            for buy_side in [0, 1]:
+                expected = self._process_scalar(StrategyRunner('', 100, hold_days, buy_side, 0.02), mdata, idxs)
+                sr = StrategyRunner('', 100, hold_days, buy_side, 0.02)
+                sr._process_positions('X', idxs, mdata)
+                self.assertTrue(len(sr.txns) > 0 or hold_days == 0)
+                self.assertEquals(expected.txns, sr.txns)
+                self.assertEquals(expected.balance, sr.balance)
+
+    def test_sweep_parity(self):
+        mdata = synthetic_mdata(300)
+        idxs = np.arange(0, 300, 3)
+        vals = np.where(idxs % 2, 100, -100)
+        strategies = sweep_grid('', 100) + sweep_grid('', -100, [0, 4, 30])
+        sw = StrategySweep(strategies)
+        sw._process_positions('X', idxs, vals, mdata)
+        for (x, r) in zip(strategies, sw.runners):
+            expected = StrategyRunner(*x)
+            expected._process_positions('X', idxs[vals == x[1]], mdata)
+            self.assertEquals(expected.txns, r.txns)
+            self.assertEquals(expected.balance, r.balance)
+        self.assertEquals(strategies[0] + (sw.runners[0].balance,), sw.results()[0])
+
+    def _exit_scalar(self, sr, mdata, open_idx, close_idx):
+        ''' Bar by bar exit, reference for vectorized exit policies '''
+        (policy, params) = sr._exit
+        (buy, limit, open_position) = (sr._buy_side, sr._limit, mdata['open'][open_idx])
+        best = open_position
+        for j in range(open_idx, close_idx):
+            (low, high, close) = (mdata['low'][j], mdata['high'][j], mdata['close'][j])
+            if policy == 'trailing':
+                stop = best * (1 - limit) if buy else best * (1 + limit)
+                if (low < stop) if buy else (high > stop):
+                    return (j, stop)
+                best = max(best, high) if buy else min(best, low)
+            elif policy == 'target':
+                (stop, take) = (open_position * (1 - limit), open_position * (1 + params[0])) if buy else (open_position * (1 + limit), open_position * (1 - params[0]))
+                if (low < stop) if buy else (high > stop):
+                    return (j, stop)
+                if (high >= take) if buy else (low <= take):
+                    return (j, take)
+            elif policy == 'bands':
+                stop = open_position * (1 - limit) if buy else open_position * (1 + limit)
+                if (low < stop) if buy else (high > stop):
+                    return (j, stop)
+                closes = mdata['close'][max(j - params[0] + 1, 0):j + 1]
+                if j >= params[0] - 1 and abs(close - closes.mean()) > params[1] * closes.std():
+                    return (j, close)
+        return (close_idx, mdata['open'][close_idx])
+
+    def test_exit_policies(self):
+        mdata = synthetic_mdata(300)
+        idxs = np.arange(0, 300, 2)
+        for policy in ['trailing', 'target:0.03', 'bands:10:1.5']:
+            for buy_side in [0, 1]:
+                sr = StrategyRunner('', 100, 9, buy_side, 0.02, exit_policy=policy)
+                sr._process_positions('X', idxs, mdata)
+                (_, open_idx, close_idx) = sr._positions(idxs, mdata)
+                self.assertEquals(len(open_idx), len(sr.txns))
+                exits = [self._exit_scalar(sr, mdata, o, c) for (o, c) in zip(open_idx, close_idx)]
+                self.assertTrue(any(j < c for ((j, _), c) in zip(exits, close_idx)))
+                for ((j, price), txn) in zip(exits, sr.txns):
+                    self.assertEquals(mdata['date'][j], txn[2])
+                    self.assertAlmostEqual(price, txn[4])
+        self.assertEquals(('bands', [20, 2.0]), parse_exit_policy('bands'))
+        self.assertEquals(('target', [0.1]), parse_exit_policy('target:0.1'))
+        self.assertRaises(ValueError, parse_exit_policy, 'trailing:1')
+        for spec in ['bands:0', 'bands:20:-1', 'bands:20:0', 'target:-1', 'target:0', 'bands:2.5']:
+            self.assertRaises(ValueError, parse_exit_policy, spec)
+
+    def test_exit_sweep_parity(self):
+        mdata = synthetic_mdata(300)
+        idxs = np.arange(0, 300, 3)
+        vals = np.where(idxs % 2, 100, -100)
+        strategies = sweep_grid('', 100) + sweep_grid('', -100, [0, 4, 30])
+        calls = []
+        rolling = backtesting.rolling_mean_std
+        backtesting.rolling_mean_std = lambda *args: calls.append(args) or rolling(*args)
+        try:
+            sw = StrategySweep(strategies, exit_policy='bands')
+            sw._process_positions('X', idxs, vals, mdata)
+        finally:
+            backtesting.rolling_mean_std = rolling
+        self.assertEquals(1, len(calls))  # bands are shared by all runners of symbol
+        for policy in ['trailing', 'target', 'bands']:
+            sw = StrategySweep(strategies, exit_policy=policy)
+            sw._process_positions('X', idxs, vals, mdata)
+            for (x, r) in zip(strategies, sw.runners):
+                expected = StrategyRunner(*x, exit_policy=policy)
+                expected._process_positions('X', idxs[vals == x[1]], mdata)
+                self.assertEquals(expected.txns, r.txns)
+                self.assertEquals(expected.balance, r.balance)
+            limit_rows = dict(((x[:4], r.balance), x[4]) for (x, r) in zip(strategies, sw.runners))
+            self.assertTrue(len(limit_rows) > len(set(k for (k, _) in limit_rows)))  # limit is a stop loss of every policy
+
     def test_process_long_position(self):
         s = StrategyRunner('', [], 0, True, 0.02, txn_amount=100)
 
@@ -128,10 +521,330 @@ class TestStrategyRunner(unittest.TestCase):
         self.assertAlmostEqual(-2.349, s._process_short_position(100, 90, 103), 2)
 
 
+class TestBacktestingOutput(unittest.TestCase):
+    def test_output_results(self):
+        path = tempfile.mkdtemp()
+        try:
+            output_results(path, iter([('CDLX', 100, 1, 1, 0.01, 5.0), ('CDLX', -100, 1, 1, 0.01, -5.0)]))
+            with open(os.path.join(path, 'backtesting.html')) as f:
+                self.assertEquals(2, f.read().count('CDLX'))
+            with open(os.path.join(path, 'profit.html')) as f:
+                profit = f.read()
+            self.assertEquals(1, profit.count('CDLX'))
+            self.assertTrue('-5.000000' not in profit)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestTxnLog(unittest.TestCase):
+    def test_roundtrip(self):
+        path = tempfile.mkdtemp()
+        try:
+            strategies = [('CDLX', 100, 1, 1, 0.01), ('CDLX', -100, 2, 0, 0.02), ('CDLY', 100, 3, 1, 0.03)]
+            create_log(path, ['A', 'B'], strategies)
+            d = np.datetime64('2012-01-03')
+            log = TxnLogWriter(path, ['A', 'B'])
+            log.append(2, [('B', d, d + 1, 1.0, 2.0, 3.0)])
+            log.append(0, [('A', d, d + 2, 4.0, 5.0, 6.0), ('B', d + 1, d + 3, 7.0, 8.0, -9.0)])
+            log.append(1, [])
+
+            res = TxnLog(path)
+            self.assertEquals(strategies, res.strategies)
+            self.assertEquals([('A', d, d + 2, 4.0, 5.0, 6.0), ('B', d + 1, d + 3, 7.0, 8.0, -9.0)], res.txns(0))
+            self.assertEquals([], res.txns(1))
+            self.assertEquals([('B', d, d + 1, 1.0, 2.0, 3.0)], res.txns(2))
+        finally:
+            shutil.rmtree(path)
+
+
+class TestEventsOutput(unittest.TestCase):
+    def test_lazy_charts(self):
+        o = AverageChange(2)
+        for x in ['open', 'high', 'low', 'close']:
+            o.add(x, 1, [1.0, 1.1])
+        outpath = output_events([('CDLX:100', o)], ['f', datetime(2012, 1, 1), datetime(2012, 1, 31)], charts='lazy')
+        try:
+            with open(os.path.join(outpath, 'charts.json')) as f:
+                self.assertEquals(['CDLX:100.png'], [x for (x, _) in json.load(f)])
+            self.assertFalse(os.path.exists(os.path.join(outpath, 'CDLX:100.png')))
+        finally:
+            shutil.rmtree(outpath)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        resultcache.set_result_cache_dir(self.path)
+
+    def tearDown(self):
+        resultcache.set_result_cache_dir(None)
+        shutil.rmtree(self.path)
+
+    def test_roundtrip(self):
+        mdata = synthetic_mdata(50)
+        key = resultcache.make_key('X', resultcache.data_hash(mdata), datetime(2012, 1, 1))
+        self.assertEquals(None, resultcache.load('test', key))
+        resultcache.save('test', key, {'a': [1, 2]})
+        self.assertEquals({'a': [1, 2]}, resultcache.load('test', key))
+        mdata['close'][-1] += 1
+        self.assertNotEquals(key, resultcache.make_key('X', resultcache.data_hash(mdata), datetime(2012, 1, 1)))
+
+    def test_cached_sweep(self):
+        from_date = datetime(2012, 1, 1)
+        to_date = datetime(2012, 12, 31)
+        symbols = ['AZN.L', 'FRES.L', 'IAG.L']
+        init_marketdata(symbols, from_date, to_date)
+
+        strategies = sweep_grid('CDL3WHITESOLDIERS', 100, [3, 5], [0, 1], [0.02])
+        StrategySweep(strategies[:2])(symbols, from_date, to_date)
+        cached = StrategySweep(strategies)(symbols, from_date, to_date)  # first two strategies come from cache
+        resultcache.set_result_cache_dir(None)
+        expected = StrategySweep(strategies)(symbols, from_date, to_date)
+        self.assertEquals(expected.results(), cached.results())
+        self.assertEquals([r.txns for r in expected.runners], [r.txns for r in cached.runners])
+
+
+class SyntheticMarketdataTest(unittest.TestCase):
+    ''' Marketdata source of synthetic data of symbols, one year from 1970-01-01 '''
+    symbols = ['A', 'B', 'C']
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        files = FileMarketdata(self.path)
+        for (i, s) in enumerate(self.symbols):
+            files.save(s, synthetic_mdata(365, i))
+        self.cache_dir = mktdata._cache_dir
+        mktdata.set_cache_dir(None)
+        mktdata.set_marketdata_source(files)
+        self.from_date = datetime(1970, 1, 1)
+        self.to_date = datetime(1970, 12, 31)
+
+    def busiest_pattern(self):
+        ''' (pattern, value) with the most events in synthetic data, so that strategies of it have transactions '''
+        data = [x for (_, x) in prefetch_mkt_data(self.symbols, self.from_date, self.to_date)]
+        counts = {}
+        for a in talib_candlestick_funcs():
+            for x in data:
+                for v in talib_events(a, x)[1]:
+                    counts[(a, int(v))] = counts.get((a, int(v)), 0) + 1
+        return max(sorted(counts), key=counts.get)
+
+    def tearDown(self):
+        use_shared_mkt_data(None)
+        mktdata.set_marketdata_source(None)
+        mktdata.set_cache_dir(self.cache_dir)
+        shutil.rmtree(self.path)
+
+
+class TestScanService(SyntheticMarketdataTest):
+    def test_requests(self):
+        funcs = talib_candlestick_funcs()
+        service = ScanService(self.symbols, funcs, self.from_date, datetime(1970, 6, 30))
+        files = mktdata._source
+        requests = []
+
+        def source(symbol, from_date, to_date):
+            requests.append(from_date)
+            return files(symbol, from_date, to_date)
+
+        mktdata.set_marketdata_source(source)
+        mktdata.set_cache_dir(os.path.join(self.path, 'cache'))
+        self.assertEquals({'to': '1970-12-31', 'new_bars': 3 * 184}, service.reload(self.to_date, fetch=False))
+        self.assertEquals([datetime(1970, 7, 1)] * 3, requests)  # only new bars are read
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'cache')))
+        mktdata.set_cache_dir(None)
+        mktdata.set_marketdata_source(files)
+        fresh = ScanService(self.symbols, funcs, self.from_date, self.to_date)
+        for a in funcs:
+            for s in self.symbols:
+                self.assertEquals([x.tolist() for x in fresh._events[a][s]], [x.tolist() for x in service._events[a][s]])
+        pattern = max(funcs, key=lambda a: sum(len(x[0]) for x in service._events[a].values()))
+        use_shared_mkt_data(None)
+        expected = CandlestickPatternEvents(self.symbols, [pattern], self.from_date, self.to_date)()
+        value = int(np.concatenate([x[1] for x in service._events[pattern].values()])[0])
+        strategies = sweep_grid(pattern, value, [3, 5], [0, 1], [0.02])
+        sweep = StrategySweep(strategies)(self.symbols, self.from_date, self.to_date)
+
+        path = os.path.join(self.path, 'scan.sock')
+        server = ScanServer(service, path)
+        thread = threading.Thread(target=server.serve)
+        thread.daemon = True  # failed test should not hang on running server
+        thread.start()
+        client = ScanClient(path)
+        try:
+            res = client.request('events', pattern=pattern)
+            self.assertEquals([(k, val.cnt(), list(val.average('close'))) for (k, val) in expected.average_changes],
+                              [(x['key'], x['events'], x['close']) for x in res['stats']])
+            res = client.request('backtest', strategies=strategies)
+            self.assertEquals([list(x) for x in sweep.results()], [x[:-1] for x in res['results']])
+            self.assertEquals([len(r.txns) for r in sweep.runners], [x[-1] for x in res['results']])
+            self.assertRaises(RuntimeError, client.request, 'events', pattern='CDLUNKNOWN')
+            self.assertEquals({'symbols': 3, 'patterns': len(funcs), 'from': '1970-01-01', 'to': '1970-12-31'}, client.request('status'))
+
+            def broken(symbol, from_date, to_date):
+                raise IOError('marketdata db is down')
+
+            mktdata.set_marketdata_source(broken)
+            logging.disable(logging.ERROR)
+            try:
+                self.assertRaises(RuntimeError, client.request, 'reload', to='19710131', fetch=False)
+                server.handle_timeout()  # scheduled reload
+            finally:
+                logging.disable(logging.NOTSET)
+            self.assertEquals('1970-12-31', client.request('status')['to'])  # previous data are still served
+            self.assertEquals(res, client.request('backtest', strategies=strategies))
+            client.request('stop')
+        finally:
+            client.close()
+            thread.join(10)
+        self.assertFalse(os.path.exists(path))
+
+
+class TestOutOfCore(SyntheticMarketdataTest):
+    symbols = ['A', 'B', 'C', 'D', 'E']
+
+    def test_symbol_chunks(self):
+        self.assertEquals([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]], list(symbol_chunks(range(10), 4)))
+        self.assertEquals([4, 2, 1, 1, 1, 1], [len(x) for x in symbol_chunks(range(10), 4, memory_limit=1)])
+
+    def test_chunked_events(self):
+        funcs = talib_candlestick_funcs()
+        expected = CandlestickPatternEvents(self.symbols, funcs, self.from_date, self.to_date, details=True)()
+        chunked = CandlestickPatternEvents(self.symbols, funcs, self.from_date, self.to_date, details=True, chunk_size=2)()
+        self.assertEquals([(k, val.cnt(), [val.average(m) for m in ['open', 'high', 'low', 'close']]) for (k, val) in expected.average_changes],
+                          [(k, val.cnt(), [val.average(m) for m in ['open', 'high', 'low', 'close']]) for (k, val) in chunked.average_changes])
+        expected.save_event_table(os.path.join(self.path, 'expected.npz'))
+        chunked.save_event_table(os.path.join(self.path, 'chunked.npz'))
+        (a, b) = [np.load(os.path.join(self.path, x)) for x in ['expected.npz', 'chunked.npz']]
+        self.assertEquals(sorted(a.keys()), sorted(b.keys()))
+        for k in a.keys():
+            self.assertEquals(a[k].dtype, b[k].dtype)
+            np.testing.assert_array_equal(a[k], b[k])  # NaN after window length compare equal
+        self.assertTrue(len(a['symbol']) > 0)
+        mapped = load_npz(os.path.join(self.path, 'chunked.npz'))
+        self.assertTrue(isinstance(mapped['window'], np.memmap))
+        for k in a.keys():
+            np.testing.assert_array_equal(a[k], mapped[k])
+        self.assertEquals([(k, repr(v)) for (k, v) in sorted(expected.average_changes)],
+                          [(k, repr(v)) for (k, v) in sorted(EventTable(chunked.event_table_columns()).average_changes())])
+        spill_dir = chunked._spill_dir
+        self.assertTrue(os.path.isdir(spill_dir))
+        chunked.close()
+        self.assertFalse(os.path.exists(spill_dir))
+
+    def test_pattern_batches(self):
+        (pattern, value) = self.busiest_pattern()
+        strategies = sweep_grid(pattern, value, [3, 5], [0, 1], [0.02])
+        data = list(prefetch_mkt_data(self.symbols, self.from_date, self.to_date))
+        events = dict((s, talib_events(pattern, x)) for (s, x) in data)
+        expected = StrategySweep(strategies)(self.symbols, self.from_date, self.to_date, events)
+        self.assertTrue(sum(len(r.txns) for r in expected.runners) > 0)
+        self.assertEquals(sorted(events.keys()), sorted(pattern_event_index(pattern, data).keys()))
+        for (s, x) in pattern_event_index(pattern, data).items():
+            self.assertEquals([y.tolist() for y in events[s]], [y.tolist() for y in x])
+        self.assertEquals(['A', 'B'], [s for (s, _) in next(symbol_batches(data, 2))])
+        batch = backtesting.PATTERN_BATCH
+        backtesting.PATTERN_BATCH = 2
+        try:
+            batched = StrategySweep(strategies)(self.symbols, self.from_date, self.to_date)
+        finally:
+            backtesting.PATTERN_BATCH = batch
+        self.assertEquals(expected.results(), batched.results())
+        self.assertEquals([r.txns for r in expected.runners], [r.txns for r in batched.runners])
+
+    def test_chunked_backtesting(self):
+        (pattern, value) = self.busiest_pattern()
+        strategies = sweep_grid(pattern, value, [3, 5], [0, 1], [0.02]) + sweep_grid(pattern, -value, [3], [0, 1], [0.02])
+        (expected, chunked, pooled) = [os.path.join(self.path, x) for x in ['expected', 'chunked', 'pooled']]
+        for x in [expected, chunked, pooled]:
+            os.mkdir(x)
+            create_log(x, self.symbols, strategies)
+        res = pattern_runner((expected, self.symbols, self.from_date, self.to_date, list(enumerate(strategies)), 'fixed'))
+        self.assertEquals([x for (_, x) in res], chunked_runner(chunked, self.symbols, self.from_date, self.to_date, group_strategies(strategies), 'fixed', 2))
+        self.assertEquals([x for (_, x) in res], chunked_runner(pooled, self.symbols, self.from_date, self.to_date, group_strategies(strategies), 'fixed', 2, async=True, workers=2))
+        (a, b, c) = (TxnLog(expected), TxnLog(chunked), TxnLog(pooled))
+        for i in range(len(strategies)):
+            self.assertEquals(a.txns(i), b.txns(i))
+            self.assertEquals(a.txns(i), c.txns(i))
+        self.assertTrue(sum(len(a.txns(i)) for i in range(len(strategies))) > 0)
+
+
+class TestStartup(unittest.TestCase):
+    IMPORT_BUDGET = 1.0  # seconds
+
+    def test_compute_modules_import(self):
+        code = 'import time; start = time.time(); import backtesting, events, walkforward, sys; print("%f %d" % (time.time() - start, "matplotlib" in sys.modules))'
+        (seconds, plotting) = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))).split()
+        self.assertEquals('0', plotting)  # matplotlib is imported only when charts are rendered
+        self.assertLess(float(seconds), self.IMPORT_BUDGET)
+
+
+class TestProfiling(SyntheticMarketdataTest):
+    def tearDown(self):
+        profiling.enable(False)
+        profiling.take_stats()
+        SyntheticMarketdataTest.tearDown(self)
+
+    def test_timed_and_report(self):
+        @profiling.timed('stage', lambda x: 'CDLX')
+        def f(x):
+            return x + 1
+
+        self.assertEquals(2, f(1))
+        self.assertEquals({}, profiling.take_stats())
+        profiling.enable()
+        f(1)
+        f(2)
+        profiling.count('lru_hit')
+        (res, stats) = profiling.Job(f)(1)
+        self.assertEquals(2, res)
+        profiling.merge(stats)
+        profiling.merge({'PoolWorker-1': {'stages': {'stage': [1, 0.5]}, 'patterns': {}, 'counters': {'lru_miss': 1}}})
+        total = profiling.summary()
+        self.assertEquals(4, total['stages']['stage'][0])
+        self.assertEquals(3, total['patterns']['CDLX']['stage'][0])
+        path = tempfile.mkdtemp()
+        try:
+            profiling.write_report(path)
+            self.assertTrue(os.path.exists(os.path.join(path, 'timing.html')))
+            with open(os.path.join(path, 'timing.json')) as fp:
+                self.assertAlmostEquals(0.5, json.load(fp)['lru_hit_rate'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_counters_of_threads(self):
+        profiling.enable()
+
+        def load(symbol):
+            for _ in range(50):
+                get_mkt_data(symbol, self.from_date, self.to_date)
+                profiling.count('loads')
+        threads = [threading.Thread(target=load, args=(s,)) for s in self.symbols]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        counters = profiling.summary()['counters']
+        self.assertEquals(50 * len(self.symbols), counters['loads'])
+        self.assertEquals(len(self.symbols), counters['lru_miss'])  # hits of other threads don't turn a miss into a hit
+        self.assertEquals(49 * len(self.symbols), counters['lru_hit'])
+
+
 if __name__ == '__main__':
     test_support.run_unittest(TestAverageChange)
+    test_support.run_unittest(TestSignificance)
     test_support.run_unittest(TestFindCandlestickPatterns)
+    test_support.run_unittest(TestIncrementalPatternDetector)
     test_support.run_unittest(EventsRegressionTest)
+    test_support.run_unittest(WalkForwardRegressionTest)
     test_support.run_unittest(TestMarketDataModule)
     test_support.run_unittest(StrategyRunnerRegressionTest)
     test_support.run_unittest(TestStrategyRunner)
+    test_support.run_unittest(TestBacktestingOutput)
+    test_support.run_unittest(TestTxnLog)
+    test_support.run_unittest(TestEventsOutput)
+    test_support.run_unittest(TestResultCache)
+    test_support.run_unittest(TestScanService)
+    test_support.run_unittest(TestOutOfCore)
+    test_support.run_unittest(TestStartup)
+    test_support.run_unittest(TestProfiling)
@@ -0,0 +1,89 @@
+# coding:utf-8
+'''
+Compact binary transaction log of a backtesting run.
+All workers append fixed-width records to one file, HTML tables are generated from it on demand.
+'''
+import os
+import json
+import fcntl
+import numpy as np
+import profiling
+
+
+TXNS_FILE = 'txns.bin'
+META_FILE = 'txns.json'
+
+TxnDType = np.dtype([('strategy', '<i4'), ('symbol', '<i4'), ('buy_date', '<M8[D]'), ('sell_date', '<M8[D]'),
+                     ('buy_price', '<f8'), ('sell_price', '<f8'), ('profit', '<f8')])
+
+
+def create_log(outpath, symbols, strategies):
+    ''' Creates empty log, symbol and strategy ids in records are positions in symbols and strategies lists '''
+    with open(os.path.join(outpath, META_FILE), 'w') as f:
+        json.dump({'symbols': list(symbols), 'strategies': [list(x) for x in strategies]}, f)
+    open(os.path.join(outpath, TXNS_FILE), 'wb').close()
+
+
+class TxnLogWriter(object):
+    def __init__(self, outpath, symbols=None):
+        '''
+        symbols - symbols of the log, read from log metadata if omitted (e.g. writer of a chunk of symbols)
+        '''
+        if symbols is None:
+            with open(os.path.join(outpath, META_FILE)) as f:
+                symbols = json.load(f)['symbols']
+        self._fname = os.path.join(outpath, TXNS_FILE)
+        self._symbol_ids = dict((s, i) for (i, s) in enumerate(symbols))
+
+    @profiling.timed('output')
+    def append(self, strategy_id, txns):
+        '''
+        txns - StrategyRunner.txns: [(symbol, buy_date, sell_date, buy_price, sell_price, profit), ...]
+        All records of one call are written at once under file lock, so they are contiguous in the log.
+        '''
+        if len(txns) == 0:
+            return
+        cols = zip(*txns)
+        rec = np.empty(len(txns), dtype=TxnDType)
+        rec['strategy'] = strategy_id
+        rec['symbol'] = [self._symbol_ids[s] for s in cols[0]]
+        for (i, x) in enumerate(TxnDType.names[2:], 1):
+            rec[x] = cols[i]
+        data = rec.tostring()
+        fd = os.open(self._fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)  # releases lock
+
+
+class TxnLog(object):
+    ''' Read-only view of transaction log with index by strategy '''
+    def __init__(self, outpath):
+        with open(os.path.join(outpath, META_FILE)) as f:
+            meta = json.load(f)
+        self.symbols = [str(x) for x in meta['symbols']]
+        self.strategies = [(str(x[0]),) + tuple(x[1:]) for x in meta['strategies']]
+        fname = os.path.join(outpath, TXNS_FILE)
+        if os.path.getsize(fname) > 0:
+            self._records = np.memmap(fname, dtype=TxnDType, mode='r')
+        else:
+            self._records = np.empty(0, dtype=TxnDType)
+        self._order = np.argsort(self._records['strategy'], kind='mergesort')
+        self._bounds = np.searchsorted(self._records['strategy'][self._order], np.arange(len(self.strategies) + 1))
+
+    def records(self, strategy_id):
+        ''' Records of strategy in the order they were booked '''
+        return self._records[self._order[self._bounds[strategy_id]:self._bounds[strategy_id + 1]]]
+
+    def balance(self, strategy_id):
+        ''' Sum of strategy profits in booking order, the same as StrategyRunner.balance '''
+        profit = self.records(strategy_id)['profit']
+        return np.add.accumulate(np.append(0, profit))[-1] if len(profit) else 0
+
+    def txns(self, strategy_id):
+        ''' Transactions of strategy in StrategyRunner.txns format '''
+        rec = self.records(strategy_id)
+        return zip([self.symbols[x] for x in rec['symbol']], rec['buy_date'], rec['sell_date'], rec['buy_price'], rec['sell_price'], rec['profit'])
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# coding:utf-8
+'''
+Walk-forward analysis: event statistics and strategies P&L over rolling in-sample/out-of-sample windows
+'''
+import os
+import time
+import calendar
+import argparse
+import profiling
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from helpers import talib_candlestick_funcs, load_symbols, stack_ohlc, find_pattern_event_matrix, matrix_pattern_events, create_result_dir, table_header, table_row, table_close, mkdate
+from mktdata import init_marketdata, get_mkt_data, prefetch_mkt_data, date_range_index, slice_mkt_data
+from events import CandlestickPatternEvents, filter_average_changes
+from backtesting import StrategySweep, load_strategies, group_strategies
+
+
+def _add_months(d, n):
+    month = d.month - 1 + n
+    year = d.year + month / 12
+    month = month % 12 + 1
+    return datetime(year, month, min(d.day, calendar.monthrange(year, month)[1]))
+
+
+def walk_forward_windows(from_date, to_date, train_months, test_months, step_months=None):
+    '''
+    Rolling windows [(train_from, train_to, test_from, test_to), ...], all dates inclusive.
+    Out-of-sample period directly follows in-sample one, windows move by step_months (test_months by default).
+    '''
+    res = []
+    while True:
+        shift = len(res) * (step_months or test_months)  # from from_date, so day of month doesn't drift
+        (start, test_from, test_end) = [_add_months(from_date, shift + x) for x in [0, train_months, train_months + test_months]]
+        if test_end - timedelta(days=1) > to_date:
+            return res
+        res.append((start, test_from - timedelta(days=1), test_from, test_end - timedelta(days=1)))
+
+
+class WalkForward(object):
+    '''
+    Market data of every symbol is loaded once for the whole span and patterns are detected once,
+    each window is evaluated by slicing bars and events of the window.
+    Patterns are detected over the full history, so events at the start of window see bars before it
+    (a separate run over the window only would miss events within talib lookback of its start).
+    '''
+    def __init__(self, symbols, candlestick_funcitons, strategies, from_date, to_date, windows, workers=1):
+        '''
+        strategies - strategies params as in strategies file, evaluated in every window
+        '''
+        self._symbols = symbols
+        self._palg = candlestick_funcitons
+        self._strategies = strategies
+        self._from_date = from_date
+        self._to_date = to_date
+        self._windows = windows
+        self._workers = workers
+        # (window, phase) -> event statistics and StrategySweep of all strategies, phase 0 is in-sample, 1 out-of-sample
+        self._events = {}
+        self._sweeps = {}
+        for w in range(len(windows)):
+            for phase in [0, 1]:
+                self._events[(w, phase)] = CandlestickPatternEvents(symbols, candlestick_funcitons, windows[w][2 * phase], windows[w][2 * phase + 1])
+                self._sweeps[(w, phase)] = StrategySweep(strategies) if strategies else None
+
+    def _periods(self):
+        for (w, x) in enumerate(self._windows):
+            for phase in [0, 1]:
+                yield ((w, phase), x[2 * phase], x[2 * phase + 1])
+
+    def _process_symbol(self, symbol, mdata):
+        '''
+        Returns partials {(window, phase): (average changes, transactions of every strategy)} for the symbol
+        '''
+        res = {}
+        if not mdata:
+            return res
+        (block, lengths) = stack_ohlc([mdata])
+        matrix = find_pattern_event_matrix(block, lengths, self._palg)
+        events = dict((a, matrix_pattern_events(matrix, 0, p)) for (p, a) in enumerate(self._palg))
+        groups = group_strategies(self._strategies) if self._strategies else []
+        for (key, from_date, to_date) in self._periods():
+            (lo, hi) = date_range_index(mdata, from_date, to_date)
+            if hi == lo:
+                continue
+            window = slice_mkt_data(mdata, lo, hi)
+            avgs = OrderedDict()
+            for a in self._palg:
+                self._events[key]._process_patterns(self._window_events(events[a], lo, hi), window, a, avgs)
+            txns = [[] for _ in self._strategies or []]
+            for group in groups:
+                sweep = StrategySweep([x for (_, x) in group])
+                (idxs, vals) = self._window_events(events[group[0][1][0]], lo, hi)
+                sweep._process_positions(symbol, idxs, vals, window)
+                for ((i, _), r) in zip(group, sweep.runners):
+                    txns[i] = r.txns
+            res[key] = (avgs, txns)
+        return res
+
+    @staticmethod
+    def _window_events((idxs, vals), lo, hi):
+        ''' Events within bars lo:hi, indexes relative to lo '''
+        sel = (idxs >= lo) & (idxs < hi)
+        return (idxs[sel] - lo, vals[sel])
+
+    def _merge(self, partials):
+        for (key, (avgs, txns)) in sorted(partials.items()):
+            self._events[key]._merge(avgs)
+            if self._sweeps[key] is not None:
+                for (r, x) in zip(self._sweeps[key].runners, txns):
+                    r._book(x)
+
+    def __call__(self):
+        if self._workers > 1:
+            pool = Pool(self._workers)
+            partials = pool.imap(profiling.Job(symbol_walk_forward), [(s, self._palg, self._strategies, self._from_date, self._to_date, self._windows) for s in self._symbols])
+        else:
+            partials = ((self._process_symbol(s, mdata), {}) for (s, mdata) in prefetch_mkt_data(self._symbols, self._from_date, self._to_date))
+        for (res, stats) in partials:  # merged in symbols order, so results don't depend on number of workers
+            self._merge(res)
+            profiling.merge(stats)
+        if self._workers > 1:
+            pool.close()
+            pool.join()
+        return self
+
+    def event_rows(self, diff_level, min_cnt):
+        '''
+        Patterns selected in-sample by filter_average_changes with their out-of-sample statistics:
+        [(window, pattern, in-sample events, in-sample close change, out-of-sample events, out-of-sample close change), ...]
+        close change is average close of the last considered day relative to next day open
+        '''
+        res = []
+        for w in range(len(self._windows)):
+            test = dict(self._events[(w, 1)].average_changes)
+            for (k, val) in filter_average_changes(self._events[(w, 0)].average_changes, diff_level, min_cnt):
+                oos = test.get(k)
+                res.append((w, k, val.cnt(), val.average('close')[-1], oos.cnt() if oos else 0, oos.average('close')[-1] if oos else float('nan')))
+        return res
+
+    def strategy_rows(self):
+        '''
+        [(window, strategy params..., in-sample profit, out-of-sample profit), ...]
+        '''
+        if not self._strategies:
+            return []
+        return [(w, ) + r0.params() + (r0.balance, r1.balance)
+                for w in range(len(self._windows))
+                for (r0, r1) in zip(self._sweeps[(w, 0)].runners, self._sweeps[(w, 1)].runners)]
+
+
+def symbol_walk_forward((symbol, candlestick_funcitons, strategies, from_date, to_date, windows)):
+    ''' Pool job: walk-forward partials for one symbol '''
+    return WalkForward([symbol], candlestick_funcitons, strategies, from_date, to_date, windows)._process_symbol(symbol, get_mkt_data(symbol, from_date, to_date))
+
+
+def output_results(outpath, windows, event_rows, strategy_rows):
+    ''' Writes per window tables to walkforward.html '''
+    def dates(w):
+        return tuple(x.strftime('%Y-%m-%d') for x in windows[w])
+
+    header = ['In-sample from', 'In-sample to', 'Out-of-sample from', 'Out-of-sample to']
+    with open(os.path.join(outpath, 'walkforward.html'), 'w') as f:
+        if strategy_rows:
+            f.write('<h3>Strategies</h3>')
+            table_header(f, header + ['Pattern', 'Pattern params', 'Hold days', 'Buy side', 'Limit', 'In-sample profit', 'Out-of-sample profit'])
+            for x in strategy_rows:
+                table_row(f, dates(x[0]) + x[1:], ['%s'] * 4 + ['%s', '%d', '%d', '%d', '%f', '%f', '%f'])
+            table_close(f)
+        f.write('<h3>Events</h3>')
+        table_header(f, header + ['Pattern', 'In-sample events', 'In-sample close change', 'Out-of-sample events', 'Out-of-sample close change'])
+        for x in event_rows:
+            table_row(f, dates(x[0]) + x[1:], ['%s'] * 4 + ['%s', '%d', '%f', '%d', '%f'])
+        table_close(f)
+
+
+def walkforward_main(fname, from_date, to_date, strategies, train_months, test_months, step_months=None, workers=1, profile=False):
+    start = time.time()
+    profiling.enable(profile)
+    symbols = load_symbols(fname)
+    init_marketdata(symbols, from_date, to_date)
+    windows = walk_forward_windows(from_date, to_date, train_months, test_months, step_months)
+    strategies_cfg = load_strategies(strategies) if strategies else None
+
+    wf = WalkForward(symbols, talib_candlestick_funcs(), strategies_cfg, from_date, to_date, windows, workers)()
+
+    diff_level = 0.02  # select patterns where up/down > diff_level
+    min_cnt = 10  # select patterns with > min_cnt events
+
+    outpath = create_result_dir('walkforward')
+    output_results(outpath, windows, wf.event_rows(diff_level, min_cnt), wf.strategy_rows())
+
+    if profile:
+        profiling.add('total', time.time() - start)
+        profiling.write_report(outpath)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward candlestick events and strategies analysis')
+    parser.add_argument('-f', '--fromdate', metavar='YYYYMMDD', type=mkdate, required=True, help='from date in format YYYYMMDD')
+    parser.add_argument('-t', '--todate', metavar='YYYYMMDD', type=mkdate, required=True, help='to date in format YYYYMMDD')
+    parser.add_argument('-s', '--shares', metavar='FILENAME', type=str, required=True, help='file with list of shares')
+    parser.add_argument('strategies', metavar='STRATEGIES_FILE', type=str, nargs='?', help='strategies evaluated in every window, events only if omitted')
+    parser.add_argument('--train', metavar='MONTHS', type=int, default=24, help='in-sample period')
+    parser.add_argument('--test', metavar='MONTHS', type=int, default=6, help='out-of-sample period')
+    parser.add_argument('--step', metavar='MONTHS', type=int, help='windows step, out-of-sample period by default')
+    parser.add_argument('-w', '--workers', metavar='N', type=int, default=cpu_count(), help='number of worker processes')
+    parser.add_argument('--profile', action='store_true', help='write per stage timing report to results directory')
+
+    args = parser.parse_args()
+    walkforward_main(args.shares, args.fromdate, args.todate, args.strategies, args.train, args.test, args.step, args.workers, args.profile)